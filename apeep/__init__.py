@@ -1,8 +1,17 @@
+from .buffers import *
+from .checkpoint import *
 from .configure import *
 from .enhance import *
 from .environ import *
+from .flat_field import *
+from .histogram import *
 from .log import *
 from .measure import *
+from .orientation import *
+from .parallel import *
+from .pixels import *
+from .process import *
 from .segment import *
 from .semantic import *
+from .shards import *
 from .stream import *
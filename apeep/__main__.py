@@ -14,21 +14,28 @@ import logging
 import os
 import sys
 from datetime import datetime, timedelta
-import tarfile
-import shutil
 
 import numpy as np
 import pandas as pd
 
 import apeep
 import apeep.timers as t
-#import apeep.im_pillow as im
-import apeep.im_opencv as im
-#import apeep.im_lycon as im
-from apeep import stack
 #from ipdb import set_trace as db
 
 
+def image_or_time(x):
+    """
+    Parse an image number or a date and time given on the command line
+    """
+    if x.isdigit():
+        if int(x) < 1:
+            raise argparse.ArgumentTypeError('image numbers start at 1')
+        return(int(x))
+    try:
+        return(pd.Timestamp(x).to_pydatetime())
+    except ValueError:
+        raise argparse.ArgumentTypeError('"' + x + '" is neither an image number nor a date and time')
+
 def main():
     
     ## Parse command line arguments ----
@@ -41,6 +48,20 @@ def main():
         help='path to the project.')
     parser.add_argument('-d', '--debug', dest='debug', action='store_true',
         help='print debug messages.')
+    parser.add_argument('-b', '--benchmark', dest='benchmark', type=int, metavar='N',
+        help='decode N frames of the input with each decoder, report their speed, and exit.')
+    parser.add_argument('--start', dest='start', type=image_or_time, metavar='IMAGE|TIME',
+        help='start processing at this image, given by its number (the first image of the input being 1) or by a date and time within it (e.g. 2020-01-01T10:00:00).')
+    parser.add_argument('--end', dest='end', type=image_or_time, metavar='IMAGE|TIME',
+        help='stop processing after this image, given in the same way.')
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true',
+        help='resume processing after the last image written by a previous, interrupted, run of the project.')
+    parser.add_argument('--shards', dest='shards', type=int, metavar='N',
+        help='split the images to process in N shards, write a job to process each of them in `shards/` in the project, and exit.')
+    parser.add_argument('--local', dest='local', action='store_true',
+        help='with --shards, run the jobs of the shards in local processes, simultaneously, then merge them.')
+    parser.add_argument('--merge', dest='merge', action='store_true',
+        help='merge the outputs of the shards in the project, and exit.')
 
     args = parser.parse_args()
  
@@ -80,11 +101,22 @@ Other options are documented there
     if not os.path.isabs(cfg['io']['input_dir']):
         cfg['io']['input_dir'] = os.path.join(project_dir, cfg['io']['input_dir'])
     
+    # when benchmarking decoders, stop here
+    if args.benchmark is not None:
+        fps = apeep.benchmark_decoders(cfg['io']['input_dir'], n=args.benchmark)
+        fps = {k: v for k, v in fps.items() if v is not None}
+        if len(fps) > 0:
+            log.info('fastest decoder is `' + max(fps, key=fps.get) + '`; set it in `io > decoder`')
+        sys.exit()
+    
     # if semantic segmentation is used, correct path to model weights and load model
+    # NB: with worker processes, the model is loaded in each of them
+    predictor = None
     if cfg['segment']['pipeline'] !=  'regular':
         if not os.path.isabs(cfg['segment']['sem_model_path']):
             cfg['segment']['sem_model_path'] = os.path.join(project_dir, cfg['segment']['sem_model_path'])
             cfg['segment']['sem_model_config'] = os.path.join(project_dir, cfg['segment']['sem_model_config'])
+        if cfg['io']['workers'] == 0:
             predictor = apeep.create_predictor(
                 model_weights=cfg['segment']['sem_model_path'],
                 config_file=cfg['segment']['sem_model_config'],
@@ -109,27 +141,104 @@ Other options are documented there
     line_timestep = timedelta(seconds=line_timestep)
     frame_timestep = timedelta(seconds=frame_timestep)
     
-    log.debug('initialise moving average line')
+    # index the avi files, to find frames in them without reading them
+    avi_index = apeep.avi_index(cfg['io']['input_dir'], os.path.join(project_dir, 'avi_index.tsv'))
+    n_lines = avi_index['n_frames'].sum() * img_height
+    
     step = cfg['flat_field']['step_size']
+    # make output_size a multiple of step_size
+    output_size = int(cfg['enhance']['image_size'] / step) * step
+    
+    # restrict processing to a window of images, from the command line
+    # NB: images are indexed from 0 here and times are converted to the image
+    #     which contains them; the images are those of a full run
+    start_img = 0
+    end_img = None
+    for bound in ['start', 'end']:
+        x = getattr(args, bound)
+        if x is None:
+            continue
+        if isinstance(x, datetime):
+            x = apeep.locate(avi_index, x, cfg['acq']['scan_per_s']) // output_size
+        else:
+            # NB: a date and time written without separators is all digits
+            #     and would be taken as a (huge) image number
+            n_images = n_lines // output_size
+            if x > n_images:
+                parser.error('--' + bound + ' ' + str(x) + ': there are only ' + str(n_images) +
+                    ' images in the input; write dates and times with separators (e.g. 2020-01-01T10:00:00)')
+            x = x - 1
+        if bound == 'start':
+            start_img = x
+        else:
+            end_img = x
+    if start_img > 0 or end_img is not None:
+        log.info('processing images ' + str(start_img + 1) + ' to ' + (str(end_img + 1) if end_img is not None else 'the end'))
+    
+    ## Process the project in shards ----
+    if args.shards is not None:
+        # split the images to process
+        if end_img is None:
+            end_img = n_lines // output_size - 1
+        shards = apeep.create_shards(project_dir, cfg, start_img, end_img, args.shards)
+        if args.local:
+            log.info('processing ' + str(len(shards)) + ' shards in local processes')
+            apeep.run_shards(shards)
+    if args.merge or (args.shards is not None and args.local):
+        apeep.merge_shards(project_dir)
+    if args.shards is not None or args.merge:
+        sys.exit()
+    
+    # decode input files once, in a frame cache, and read from it afterwards
+    if cfg['io']['cache']:
+        cache_dir = os.path.join(project_dir, 'cache')
+        apeep.transcode(cfg['io']['input_dir'], cache_dir, decoder=cfg['io']['decoder'])
+    else:
+        cache_dir = None
+    # define how the input is read
+    stream_opts = {
+        'decoder': cfg['io']['decoder'],
+        'prefetch': cfg['io']['prefetch'],
+        'cache': cache_dir,
+        'index': avi_index
+    }
+    
+    log.debug('initialise moving average line')
+    # type of images along the pipeline
+    dtype = cfg['io']['dtype']
     # make window_size a multiple of step_size
     window_size = int(cfg['flat_field']['window_size'] / step) * step
     # get data in the first window and compute the mean
-    input_stream = apeep.stream(dir=cfg['io']['input_dir'], n=window_size)
-    
-    window = next(input_stream)
-    mavg = np.mean(window['data'], axis=0) # columnw-wise mean
-    log.debug('moving average line initialised, mean value = ' + str(np.mean(mavg)))
+    # NB: the first frames are kept and replayed in the processing loop, so
+    #     that they are decoded only once
+    input_frames = apeep.frames(dir=cfg['io']['input_dir'], **stream_opts)
+    first_frames, input_frames = apeep.peek(input_frames, n_lines=window_size)
     
-    log.debug('initialise output image')
-    # make output_size a multiple of step_size
-    output_size = int(cfg['enhance']['image_size'] / step) * step
-    output_buffer = np.empty((output_size, img_width))
-    i_o = 0
+    window = next(apeep.blocks(first_frames, n=window_size, dtype=dtype))
+    # read a precomputed profile for static flat-fielding
+    profile = cfg['flat_field']['profile']
+    if cfg['flat_field']['method'] == 'static' and profile is not None:
+        if not os.path.isabs(profile):
+            profile = os.path.join(project_dir, profile)
+        log.info('read flat-field profile from ' + profile)
+        profile = np.load(profile)
+    else:
+        profile = None
+    ff_opts = {
+        'method': cfg['flat_field']['method'],
+        'window_size': window_size,
+        'step': step,
+        'refresh': cfg['flat_field']['refresh_frames'] * img_height,
+        'tolerance': cfg['flat_field']['drift_tolerance']
+    }
+    ff_state = apeep.init_flat_field(window['data'], profile=profile, **ff_opts)
+    # save the computed profile, to be reused later
+    if cfg['flat_field']['method'] == 'static' and profile is None:
+        np.save(os.path.join(project_dir, 'flat_field_profile.npy'), ff_state['mavg'])
     
     ## Read environmental data ----
     # get name of first avi file
-    first_input = next(input_stream)
-    first_avi = os.path.split(first_input['filename'])[-1]
+    first_avi = os.path.split(first_frames[0]['filename'])[-1]
     
     log.debug('read environmental data')
     all_environ = glob.glob(cfg['io']['input_dir'] + '/ISIIS*.txt')
@@ -149,47 +258,223 @@ Other options are documented there
     log.info('processing one image every ' + str(subsampling_int) + ' images')
     log.info('starting at image number  ' + str(cfg['subsampling']['first_image']))
     
+    # fast-forward over the images which are not processed
+    fast_forward = cfg['subsampling']['fast_forward'] and subsampling_int > 1
+    # NB: the flat-fielding state only needs to be correct at the start of
+    #     the processed images; when jumping to them, it is recomputed from the
+    #     `window_size` lines before each of them, which are the only ones read
+    # the static profile does not need to be recomputed
+    if cfg['flat_field']['go'] and cfg['flat_field']['method'] != 'static':
+        warm_up = window_size
+    else:
+        warm_up = 0
+    # index of the next image
+    i_img = 0
+    
+    # smooth the segmentation threshold over successive processed images
+    # NB: it is computed here, in the order of the images, and passed to the
+    #     processing of each image
+    threshold_state = None
+    if cfg['segment']['go'] and cfg['segment']['threshold_window'] > 1:
+        threshold_state = apeep.init_threshold(cfg['segment']['threshold_window'])
+    
+    n_workers = cfg['io']['workers']
+    if n_workers > 0:
+        # process images in worker processes
+        # NB: each image is flat-fielded in a buffer shared with the workers
+        log.info(f'processing images with {n_workers} worker processes')
+        workers = apeep.start_workers(n_workers, shape=(output_size, img_width),
+            dtype=dtype, cfg=cfg, environ=e)
+    else:
+        # or in the main process
+        workers = None
+        log.debug('initialise output image')
+        # NB: the output image and all intermediate images are drawn from a
+        #     pool of buffers, so that they are allocated only once
+        pool = apeep.buffer_pool()
+        output_buffer = apeep.buffer(pool, 'output', (output_size, img_width), dtype)
+    
     # initialise flat-fielding timer
     timer_ff = t.b()
     timer_img = t.b()
     
-    # loop over files
-    input_stream = apeep.stream(dir=cfg['io']['input_dir'], n=step)
-    for piece in input_stream:
-        
-        # flat-field
-        if cfg['flat_field']['go']:
-            # update the moving average using an exponential decay approximation
-            # NB: allows to not store the actual window
-            #     faster than recomputing the whole mean every time
-            # NB: computing the median is another order of magnitude slower
-            mavg = mavg + (np.sum(piece['data'], axis=0) - mavg * step) / window_size
-            # log.debug('moving average line updated, mean value = ' + str(np.mean(mavg)))
-            # TODO we're doing np.sum with axis 0 (=per column) on a C contiguous array, although and F contiguous array would be faster. Look into changing this.
+    # duration of an image
+    real_time = cfg['enhance']['image_size'] / cfg['acq']['scan_per_s']
+    
+    # save a checkpoint after each image written
+    # NB: it contains the position in the stream after the image, and the
+    #     state at this point, from which processing can be resumed
+    checkpoint_file = os.path.join(project_dir, 'checkpoint.npz')
+    def checkpoint():
+        state = {
+            'next_line': i_img * output_size,
+            'subsampling_count': subsampling_count,
+            'mavg': ff_state['mavg'].copy(),
+            'age': ff_state.get('age', 0),
+            'pos': ff_state.get('pos', 0)
+        }
+        if threshold_state is not None and threshold_state['hist'] is not None:
+            hist = threshold_state['hist']
+            state.update({
+                'threshold_counts': hist['counts'].copy(),
+                'threshold_edges': hist['edges'],
+                'threshold_discrete': hist['discrete']
+            })
+        return(state)
+    
+    # restart the input stream at a given line
+    def seek(line, warm_up, replay=0):
+        # NB: the flat-fielding state is recomputed from the `warm_up` lines
+        #     before it, when there are some, and then updated with the last
+        #     `replay` of these lines
+        first_line = line - replay - warm_up
+        input_frames = apeep.frames(dir=cfg['io']['input_dir'],
+            skip=first_line // img_height, **stream_opts)
+        offset = first_line % img_height
+        state = None
+        if warm_up > 0:
+            first_frames, input_frames = apeep.peek(input_frames, n_lines=offset + warm_up + replay)
+            window = next(apeep.blocks(first_frames, n=warm_up + replay, dtype=dtype, offset=offset))
+            state = apeep.init_flat_field(window['data'][0:warm_up,:], **ff_opts)
+            if replay > 0:
+                apeep.flat_field(window['data'][warm_up:,:], state)
+            offset += warm_up + replay
+        input_stream = apeep.blocks(input_frames, n=output_size, dtype=dtype, offset=offset)
+        return(input_stream, state)
+    
+    # setup parallel processing
+    if workers is not None:
+        # checkpoints of the images being processed
+        checkpoints = {}
+        # time between the commits of processed images
+        timer_commit = t.b()
+        def commit(results):
+            # write the results of the images processed by the workers, in order
+            nonlocal timer_commit
+            for image_info, particles_props in results:
+                apeep.commit_image(particles_props, image_info, cfg)
+                apeep.write_checkpoint(checkpoint_file,
+                    dict(checkpoints.pop(image_info['img_name']), last_image=image_info['img_name']))
+                elapsed = t.e(timer_commit)
+                log.info(f"{image_info['img_name']} done ({elapsed:.3f}s @ {real_time/elapsed:.2f}x)")
+                timer_commit = t.b()
+    
+    # loop over images
+    # NB: the stream is read one image at a time and flat-fielding updates
+    #     the moving average every `step` lines within it
+    input_stream = apeep.blocks(input_frames, n=output_size, dtype=dtype)
+    
+    # resume after the last image written by a previous run
+    if args.resume:
+        resume_from = apeep.read_checkpoint(checkpoint_file)
+        if resume_from is None:
+            log.warning('no checkpoint to resume from, starting from the beginning')
+        else:
+            log.info('resuming after image ' + resume_from['last_image'])
+            next_line = resume_from['next_line']
+            if next_line % output_size != 0:
+                raise ValueError('the checkpoint was written with another `enhance > image_size`')
+            start_img = max(start_img, next_line // output_size)
+            # restore the flat-fielding state at this point
+            # NB: the moving average line is the whole state of the 'ema' and
+            #     'static' methods; for the others, the state is recomputed
+            #     from the lines before, which gives the same result for
+            #     'median'; for 'boxcar', whose running mean is only recomputed
+            #     from the window when it wraps, the state is recomputed at the
+            #     last wrap and the `pos` lines since then are replayed, so
+            #     that it is bit-identical
+            resume_replay = 0
+            if cfg['flat_field']['method'] in ('ema', 'static'):
+                resume_warm_up = 0
+            else:
+                resume_warm_up = warm_up
+                if cfg['flat_field']['method'] == 'boxcar':
+                    resume_replay = resume_from.get('pos', 0)
+            # and restart the stream there, unless the lines needed are
+            # before the start, in which case the images are read (but not
+            # processed) from the start again
+            if next_line - resume_replay - resume_warm_up >= 0:
+                input_stream.close()
+                input_stream, state = seek(next_line, resume_warm_up, resume_replay)
+                if state is None:
+                    ff_state['mavg'] = resume_from['mavg']
+                    if 'age' in ff_state:
+                        ff_state['age'] = resume_from['age']
+                else:
+                    ff_state = state
+                i_img = next_line // output_size
+                subsampling_count = resume_from['subsampling_count']
+            # restore the smoothed segmentation threshold
+            if threshold_state is not None and 'threshold_counts' in resume_from:
+                threshold_state['hist'] = {
+                    'counts': resume_from['threshold_counts'],
+                    'edges': resume_from['threshold_edges'],
+                    'discrete': resume_from['threshold_discrete']
+                }
+    
+    # NB: when processing fails or is interrupted, the workers are stopped
+    #     at once, so that no process is left running and shared memory is
+    #     released
+    try:
+        while True:
             
-            # compute flat-fielding
-            piece['data'] = piece['data'] / mavg
-        
-        # log.debug('add block to output buffer')
-        output_buffer[i_o:i_o+step,:] = piece['data']
-        
-        # store transect name, avi file, frame number and line number at beginning of image
-        if i_o == 0:
+            # find the next image to process: skip the ones before the start and,
+            # when fast-forwarding, the ones which are not processed
+            next_img = max(i_img, start_img)
+            if fast_forward:
+                next_count = subsampling_count + 1 + next_img - i_img
+                next_img += max(0, -(-next_count // subsampling_int) * subsampling_int) - next_count
+            # stop after the last image to process
+            if end_img is not None and next_img > end_img:
+                break
+            
+            # compute the number of images before the next one to process
+            n_skip = next_img - i_img
+            # and the first line to read for it
+            first_line = next_img * output_size - warm_up
+            
+            # when it is after the next image, jump there
+            if n_skip > 0 and first_line > i_img * output_size:
+                # stop if the image to process is not complete
+                if (next_img + 1) * output_size > n_lines:
+                    break
+                log.debug(f'fast-forward {n_skip} images')
+                input_stream.close()
+                # recompute the flat-fielding state from the lines before
+                input_stream, state = seek(next_img * output_size, warm_up)
+                if state is not None:
+                    ff_state = state
+                i_img += n_skip
+                subsampling_count += n_skip
+            
+            # get the next image
+            piece = next(input_stream, None)
+            if piece is None:
+                break
+            i_img += 1
+            
+            # get a free buffer to store the image, from the workers
+            if workers is not None:
+                output_buffer, results = apeep.free_slot(workers)
+                commit(results)
+            
+            # flat-field
+            if cfg['flat_field']['go']:
+                apeep.flat_field(piece['data'], ff_state, out=output_buffer)
+            else:
+                output_buffer[:] = piece['data']
+            
+            # store transect name, avi file, frame number and line number at beginning of image
             image_info = {
                 'transect_name': cfg['io']['input_dir'].split('/')[-1] if len(cfg['io']['input_dir'].split('/')[-1]) > 0 else cfg['io']['input_dir'].split('/')[-2],
-                'start_avi_file': os.path.split(piece['filename'])[1],
-                'start_frame_nb': piece['frame_nb'],
-                'start_line_nb': piece['line_nb']
-            }        
-        i_o = i_o + step
-        
-        # when output_buffer is full
-        if i_o == output_size:
+                'start_avi_file': os.path.split(piece['first_filename'])[1],
+                'start_frame_nb': piece['first_frame_nb'],
+                # NB: last line of the first flat-fielding step
+                'start_line_nb': piece['first_line_nb'] + step - 1
+            }
+            
             # end timer for flat-fielding
             elapsed = t.el(timer_ff, 'flat-field')
-
-            # reinitialise output_buffer
-            i_o = 0
             
              # store avi file, frame number and line number at end of image
             image_info.update({
@@ -198,19 +483,6 @@ Other options are documented there
                 'end_line_nb': piece['line_nb']
             })    
             
-            # rotate the image so that motion is from the left to the right
-            timer_rot = t.b()
-            if cfg['acq']['top'] == 'right':
-                output = np.rot90(output_buffer).copy(order='C')
-            elif cfg['acq']['top'] == 'left':
-                output = np.transpose(output_buffer).copy(order='C')
-                
-            # create object for downscaled image
-            output_small = None
-            # NB: the copy with C order takes time but the operations are faster afterwards and it is worth it
-            elapsed = t.el(timer_rot, 'rotate')
-            # TODO rotate the final particles only and check wether this is faster
-
             # compute the time stamp of the image
             # start of avi file + n frames + n lines in the last frame
             time_end =  piece['start'] + \
@@ -228,149 +500,42 @@ Other options are documented there
             
             # process 1 image every 'subsample_rate'
             # if subsample counter is divisible by subsampling interval and first image to process is reached
-            if (subsampling_count%subsampling_int == 0 and subsampling_count >= 0):
+            # NB: i_img is now the index of the next image
+            if (subsampling_count%subsampling_int == 0 and subsampling_count >= 0 and i_img > start_img):
+                # enhance, segment, measure and write the results
+                # NB: the image is processed in acquisition orientation (one
+                #     scanned line per row); only the written images and the
+                #     particles are oriented with the top up, so that motion is
+                #     from the left to the right
+                stats = None
+                if threshold_state is not None:
+                    stats = apeep.image_stats(output_buffer)
+                    image_info['gray_threshold'] = apeep.stream_threshold(threshold_state, stats, cfg)
+                if workers is None:
+                    particles_props = apeep.process_image(output_buffer, image_info,
+                        cfg, e, predictor=predictor, pool=pool, stats=stats)
+                    apeep.commit_image(particles_props, image_info, cfg)
+                    apeep.write_checkpoint(checkpoint_file, dict(checkpoint(), last_image=output_name))
+                else:
+                    checkpoints[output_name] = checkpoint()
+                    apeep.submit(workers, image_info, stats=stats)
             
-                if cfg['flat_field']['go']:
-                    # rescale in [0,1] to save the image
-                    minv = output.min()
-                    maxv = output.max()
-                    output_0_1 = (output - minv) / (maxv - minv)
-                    # TODO check it more thouroughly but this normalisation creates very inhomogeneous grey levels in the result
-                
-                    if cfg['flat_field']['write_image']:
-                        flat_fielded_image_dir = os.path.join(project_dir, 'flat_fielded')
-                        os.makedirs(flat_fielded_image_dir, exist_ok=True)
-                        im.save(output_0_1, os.path.join(flat_fielded_image_dir, output_name + '.png'))
-                
-                # enhance output image
-                if cfg['enhance']['go']:
-                    output = apeep.enhance(output, cfg)
-                    
-                    if cfg['enhance']['write_image']:
-                        enhanced_image_dir = os.path.join(project_dir, 'enhanced')
-                        os.makedirs(enhanced_image_dir, exist_ok=True)
-                        im.save(output, os.path.join(enhanced_image_dir, output_name + '.png'))
-                
-                # segment
-                if cfg['segment']['go']:
-                    # compute gray segmentation threshold
-                    gray_threshold = apeep.segmentation_threshold(
-                        output,
-                        method=cfg['segment']['method'],
-                        threshold=cfg['segment']['threshold']
-                    )
-                    
-                    # store gray segmentation threshold
-                    image_info.update({
-                        'gray_threshold': gray_threshold,
-                    })
-                    
-                    if cfg['segment']['pipeline'] == 'semantic':
-                        # run semantic segmentation
-                        output_masked = apeep.semantic_segment(
-                            output, 
-                            gray_threshold=gray_threshold, 
-                            predictor=predictor, 
-                            sem_upsample_size=cfg['segment']['sem_upsample_size'],
-                            sem_n_batches=cfg['segment']['sem_n_batches'],
-                            dilate=cfg['segment']['dilate'], 
-                            erode=cfg['segment']['erode'], 
-                            sem_min_area=cfg['segment']['sem_min_area'], 
-                            sem_max_area=cfg['segment']['sem_max_area']
-                        )
-                       
-                    elif cfg['segment']['pipeline'] == 'regular':
-                        # run regular segmentaion
-                        output_masked = apeep.segment(
-                            output,
-                            gray_threshold=gray_threshold,
-                            dilate=cfg['segment']['dilate'],
-                            erode=cfg['segment']['erode'],
-                            min_area=cfg['segment']['reg_min_area'],
-                            max_area=cfg['segment']['reg_max_area']
-                        )
-                        
-                    elif cfg['segment']['pipeline'] == 'both':
-                        # run semantic segmentation
-                        output_sem = apeep.semantic_segment(
-                            output, 
-                            gray_threshold=gray_threshold, 
-                            predictor=predictor,
-                            sem_upsample_size=cfg['segment']['sem_upsample_size'],
-                            sem_n_batches=cfg['segment']['sem_n_batches'],
-                            dilate=cfg['segment']['dilate'], 
-                            erode=cfg['segment']['erode'], 
-                            sem_min_area=cfg['segment']['sem_min_area'], 
-                            sem_max_area=cfg['segment']['sem_max_area']
-                        )
-                        
-                        # run regular segmentaion
-                        output_reg = apeep.segment(
-                            output,
-                            gray_threshold=gray_threshold,
-                            dilate=cfg['segment']['dilate'],
-                            erode=cfg['segment']['erode'],
-                            min_area=cfg['segment']['reg_min_area'],
-                            max_area=cfg['segment']['reg_max_area']
-                        )
-                        
-                        # merge masks
-                        output_masked = apeep.merge_masks(
-                            semantic_mask=output_sem,
-                            regular_mask=output_reg,
-                        )
-                    
-                    if cfg['segment']['write_image']:
-                        segmented_image_dir = os.path.join(project_dir, 'segmented')
-                        os.makedirs(segmented_image_dir, exist_ok=True)
-                        im.save(output_masked == 0, os.path.join(segmented_image_dir, output_name + '.png'))
-                    
-                    if cfg['segment']['write_stack']:
-                        stack_image_dir = os.path.join(project_dir, 'stacked')
-                        os.makedirs(stack_image_dir, exist_ok=True)
-                        stack.save_stack(img=output, labels=output_masked, \
-                            dest=os.path.join(stack_image_dir, output_name), format=cfg['segment']['stack_format'])
-                
-                # measure
-                if cfg['measure']['go'] and np.sum(output_masked) != 0 :
-                    particles, particles_props = apeep.measure(
-                        img=output,
-                        img_mask=output_masked,
-                        image_info=image_info,
-                        props=cfg['measure']['properties']
-                    )
-                    
-                    if cfg['measure']['write_particles']:
-                        particles_images_dir = os.path.join(project_dir, 'particles', output_name)
-                        os.makedirs(particles_images_dir, exist_ok=True)
-                        
-                        # merge particles and environment data
-                        particles_props = apeep.merge_environ(e, particles_props, output_name)
-                        
-                        # write particles images
-                        apeep.write_particles(particles, particles_images_dir, px2mm=cfg['acq']['window_height_mm']/img_width)      
-                        # and properties
-                        apeep.write_particles_props(particles_props, particles_images_dir)
-                        
-                        
-                        if cfg['measure']['as_tar']:
-                            # Create a tar archive containing particles and properties 
-                            with tarfile.open(particles_images_dir + '.tar', 'w') as tar:
-                                tar.add(particles_images_dir, arcname=os.path.basename(particles_images_dir))
-                                tar.close()
-                            
-                            # Delete directory 
-                            shutil.rmtree(particles_images_dir)
-                        
-                                    
-            # compute performance
-            elapsed = t.e(timer_img)
-            real_time = cfg['enhance']['image_size'] / cfg['acq']['scan_per_s']
-            log.info(f"{output_name} done ({elapsed:.3f}s @ {real_time/elapsed:.2f}x)")
+            if workers is None:
+                # compute performance
+                elapsed = t.e(timer_img)
+                log.info(f"{output_name} done ({elapsed:.3f}s @ {real_time/elapsed:.2f}x)")
             
             # reset flat-fielding and global timers for next iteration
             timer_ff = t.b()
             timer_img = t.b()
-                
+    except BaseException:
+        if workers is not None:
+            apeep.stop_workers(workers, wait=False)
+        raise
+    
+    # finish processing the last images
+    if workers is not None:
+        commit(apeep.stop_workers(workers))
+            
 if __name__ == "__main__":
     main()
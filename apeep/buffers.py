@@ -0,0 +1,45 @@
+import numpy as np
+
+# from ipdb import set_trace as db
+
+# Processing an image requires several arrays of the size of the image (the
+# flat-fielded and enhanced images, the thresholded mask and its labels, etc.).
+# Instead of allocating them for every image, they are drawn from a pool, a
+# dict of arrays keyed by their role, in which they are allocated for the
+# first image and then reused for all the following ones.
+
+def buffer_pool():
+    """
+    Create an empty pool of buffers
+
+    Returns:
+        dict: pool of arrays, to be passed to `buffer()`.
+    """
+    return({})
+
+def buffer(pool, name, shape, dtype='float64'):
+    """
+    Get an array from a pool of buffers
+
+    Args:
+        pool (dict): pool of buffers, from `buffer_pool()`; when None, a new
+            array is allocated.
+        name (str): role of the array; each name corresponds to a different
+            array in the pool, so the arrays used simultaneously should have
+            different names.
+        shape (tuple): shape of the array.
+        dtype: type of the array.
+
+    Returns:
+        ndarray: C-contiguous array of `shape` and `dtype`, whose content is
+            undefined (i.e. left from the previous use of the buffer).
+    """
+    if pool is None:
+        return(np.empty(shape, dtype=dtype))
+
+    x = pool.get(name)
+    # (re)allocate the buffer the first time or when it does not fit
+    if x is None or x.shape != tuple(shape) or x.dtype != np.dtype(dtype):
+        x = np.empty(shape, dtype=dtype)
+        pool[name] = x
+    return(x)
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+
+# from ipdb import set_trace as db
+
+# After each image is written, the position in the input stream and the state
+# needed to continue from there are saved in a checkpoint in the project
+# directory, so that an interrupted run can be resumed where it stopped, with
+# the same output as an uninterrupted run.
+
+def write_checkpoint(path, checkpoint):
+    """
+    Write a checkpoint
+
+    The file is replaced at once, so that a run interrupted while writing it
+    leaves the previous checkpoint intact.
+
+    Args:
+        path (str): path to the checkpoint file.
+        checkpoint (dict): content of the checkpoint, with values which are
+            numbers, strings or arrays.
+
+    Returns:
+        Nothing
+    """
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **checkpoint)
+    os.replace(path + '.tmp', path)
+    pass
+
+def read_checkpoint(path):
+    """
+    Read a checkpoint written by `write_checkpoint()`
+
+    Args:
+        path (str): path to the checkpoint file.
+
+    Returns:
+        dict: content of the checkpoint, with numbers and strings as python
+            scalars; None when the file does not exist.
+    """
+    if not os.path.exists(path):
+        return(None)
+
+    with np.load(path) as f:
+        checkpoint = {k: f[k].item() if f[k].ndim == 0 else f[k] for k in f.files}
+    return(checkpoint)
@@ -6,6 +6,8 @@ import sys
 import yaml
 import numpy as np
 
+from apeep.orientation import oriented_props
+
 #from ipdb import set_trace as db
 
 def configure(project_dir):
@@ -47,6 +49,21 @@ def configure(project_dir):
     
     # NB: do not check io > input_dir existence here because it would fail by default
 
+    assert cfg['io']['decoder'] in ('pyav', 'opencv', 'ffmpeg'), \
+            '`io > decoder` should be `pyav`, `opencv` or `ffmpeg`'
+    assert isinstance(cfg['io']['cache'], bool), \
+            '`io > cache` should be `true` or `false`'
+    assert isinstance(cfg['io']['prefetch'], int), \
+            '`io > prefetch` should be an integer'
+    assert (cfg['io']['prefetch'] >= 0), \
+            '`io > prefetch` should be >= 0'
+    assert cfg['io']['dtype'] in ('float64', 'float32', 'uint8'), \
+            '`io > dtype` should be `float64`, `float32` or `uint8`'
+    assert isinstance(cfg['io']['workers'], int), \
+            '`io > workers` should be an integer'
+    assert (cfg['io']['workers'] >= 0), \
+            '`io > workers` should be >= 0'
+
     assert cfg['acq']['top'] in ('right', 'left'), \
             '`acq > top` should be either `right` or `left`'
     assert isinstance(cfg['acq']['scan_per_s'], (int, float)), \
@@ -62,7 +79,11 @@ def configure(project_dir):
             '`subsampling > first_image` should be an integer'
     assert (cfg['subsampling']['first_image'] > 0), \
             '`subsampling > first_image` should be > 0'
+    assert isinstance(cfg['subsampling']['fast_forward'], bool), \
+            '`subsampling > fast_forward` should be `true` or `false`'
 
+    assert cfg['flat_field']['method'] in ('ema', 'boxcar', 'median', 'static'), \
+            '`flat_field > method` should be `ema`, `boxcar`, `median` or `static`'
     assert isinstance(cfg['flat_field']['window_size'], (int, float)), \
             '`flat_field > window_size` should be a number'
     assert isinstance(cfg['flat_field']['step_size'], (int, float)), \
@@ -75,6 +96,16 @@ def configure(project_dir):
     if window_size != cfg['flat_field']['window_size']:
         log.info('`flat_field > window_size` updated to ' + str(window_size))
     cfg['flat_field']['window_size'] = window_size
+    assert cfg['flat_field']['profile'] is None or isinstance(cfg['flat_field']['profile'], str), \
+            '`flat_field > profile` should be empty or a path to a .npy file'
+    assert isinstance(cfg['flat_field']['refresh_frames'], int), \
+            '`flat_field > refresh_frames` should be an integer'
+    assert (cfg['flat_field']['refresh_frames'] >= 0), \
+            '`flat_field > refresh_frames` should be >= 0'
+    assert isinstance(cfg['flat_field']['drift_tolerance'], (int, float)), \
+            '`flat_field > drift_tolerance` should be a number'
+    assert (cfg['flat_field']['drift_tolerance'] >= 0), \
+            '`flat_field > drift_tolerance` should be >= 0'
 
     assert isinstance(cfg['enhance']['image_size'], (int, float)), \
             '`enhance > image_size` should be a number'
@@ -94,6 +125,8 @@ def configure(project_dir):
             '`enhance > light_threshold` should be in [0,100]'
     assert (cfg['enhance']['dark_threshold'] <= cfg['enhance']['light_threshold']), \
             '`enhance > dark_threshold` should be smaller than `enhance > light_threshold`'
+    assert cfg['enhance']['percentiles'] in ('exact', 'histogram'), \
+            '`enhance > percentiles` should be `exact` or `histogram`'
     
     assert isin(cfg['segment']['stack_format'], ('psd', 'tif', 'rgb')), \
             '`segment > stack_format` can only be `psd`, `tif`, `rgb`'
@@ -123,6 +156,19 @@ def configure(project_dir):
     if cfg['segment']['method'] in ['static', 'percentile']:
         assert (cfg['segment']['threshold'] >= 0 and cfg['segment']['threshold'] <= 100), \
                 'if `segment > method` is `static` or `percentile`, `segment > threshold` should be in [0,100] (0, no particles; 100, select everything)'
+    assert isinstance(cfg['segment']['threshold_window'], int), \
+            '`segment > threshold_window` should be an integer'
+    assert (cfg['segment']['threshold_window'] >= 1), \
+            '`segment > threshold_window` should be >= 1'
+    if cfg['segment']['threshold_window'] > 1:
+        assert cfg['enhance']['percentiles'] == 'histogram', \
+                'if `segment > threshold_window` is > 1, `enhance > percentiles` should be `histogram`'
+    assert cfg['segment']['labelling'] in ('opencv', 'scipy'), \
+            '`segment > labelling` should be `opencv` or `scipy`'
+    assert isinstance(cfg['segment']['threads'], int), \
+            '`segment > threads` should be an integer'
+    assert (cfg['segment']['threads'] >= 1), \
+            '`segment > threads` should be >= 1'
     assert isinstance(cfg['segment']['dilate'], (int)), \
             '`segment > dilate` should be an number'
     assert isinstance(cfg['segment']['erode'], (int)), \
@@ -133,6 +179,11 @@ def configure(project_dir):
             '`segment > reg_max_area` should be an number'
     assert cfg['segment']['reg_min_area'] < cfg['segment']['reg_max_area'], \
             '`segment > reg_min_area` should smaller than `segment > reg_max_area`'
+    unoriented_props = [p for p in cfg['measure']['properties'] if p not in oriented_props]
+    assert len(unoriented_props) == 0, \
+            '`measure > properties` cannot contain ' + ', '.join(unoriented_props) + \
+            ', which would not be converted to the oriented particles; possible properties are ' + \
+            ', '.join(oriented_props)
     
     # TODO check boolean values
 
@@ -1,35 +1,85 @@
 import logging
 
+import cv2
 import skimage.transform
-import skimage.exposure
 import numpy as np
 
 import apeep.timers as t
+from apeep.pixels import compute_dtype, to_float, from_float
+from apeep.buffers import buffer
+from apeep.histogram import image_stats, percentile, recount
 
 # from ipdb import set_trace as db
 
 @t.timer
-def enhance(img, cfg):
+def enhance(img, cfg, out=None, pool=None, stats=None):
     """
     Enhance (improve contrast of) flat-fielded image
     
     Args:
-        img (ndarray): flat-fielded image (of type float)
+        img (ndarray): flat-fielded image (of floats in [0,1] or of uint8 in
+            [0,255])
         cfg (dict): configuration options
+        out (ndarray): array of the shape and type of `img` in which to store
+            the result (which can be `img` itself); when None, a new one is
+            allocated.
+        pool (dict): pool of buffers, from `buffer_pool()`, from which to draw
+            intermediate images; when None, they are allocated.
+        stats (dict): statistics of grey levels of `img`, from `image_stats()`,
+            from which the percentiles are read when `enhance > percentiles`
+            is 'histogram'; they are then updated, in place, to describe the
+            enhanced image.
     
     Returns:
-        ndarray: enhanced image (of type float)
+        ndarray: enhanced image (of the same type as `img`)
     """
     # get general logger
     log = logging.getLogger()
     
     ## Rescale max/min intensity ----
+    update_stats = stats is not None
     # compute distribution of grey levels
-    img_small = skimage.transform.rescale(img, 0.2, multichannel=False, anti_aliasing=False)
-    # NB: much faster without antialiasing and should be OK for percentile comparison
+    thresholds = (cfg['enhance']['dark_threshold'], cfg['enhance']['light_threshold'])
+    if cfg['enhance']['percentiles'] == 'histogram':
+        # read percentiles from the histogram of the pixels of the image
+        # shrunk as below, which are interpolated without shrinking the whole
+        # image and are not sorted
+        if stats is None:
+            stats = image_stats(img, stride=5)
+            update_stats = False
+        dark_limit, light_limit = enhance_limits(stats, cfg)
+    else:
+        # NB: convert raw grey levels here, rather than let skimage convert them
+        #     to a new image of float64
+        img_f = img
+        if img.dtype == np.uint8:
+            img_f = to_float(img, out=buffer(pool, 'float', img.shape, np.float32))
+        img_small = skimage.transform.rescale(img_f, 0.2, multichannel=False, anti_aliasing=False)
+        # NB: much faster without antialiasing and should be OK for percentile comparison
+        dark_limit, light_limit = np.percentile(img_small, thresholds)
     # rescale intensity based on these percentiles
-    dark_limit, light_limit = np.percentile(img_small, (cfg['enhance']['dark_threshold'],cfg['enhance']['light_threshold']))
-    img_eq = skimage.exposure.rescale_intensity(img, in_range=(dark_limit, light_limit))
+    # NB: this is equivalent to skimage.exposure.rescale_intensity() but works
+    #     by chunks of lines, which avoids several temporary copies of the image
+    img_eq = np.empty_like(img) if out is None else out
+    if img.dtype == np.uint8:
+        # compute the result for each of the 256 grey levels and look it up
+        levels = np.arange(256, dtype=np.uint8)
+        lut = _rescale_intensity(levels, dark_limit, light_limit,
+                                 out=np.empty_like(levels), tmp=np.empty(256, dtype=np.float32))
+        # NB: each pixel is read before being written, so this works in place;
+        #     np.take() would convert the whole image to indices first
+        cv2.LUT(img, lut, dst=img_eq)
+    else:
+        chunk_size = max(1, 2**18 // img.shape[1])
+        chunk_buffer = np.empty((chunk_size, img.shape[1]), dtype=img.dtype)
+        for i in range(0, img.shape[0], chunk_size):
+            n = min(chunk_size, img.shape[0] - i)
+            _rescale_intensity(img[i:i+n,:], dark_limit, light_limit,
+                               out=img_eq[i:i+n,:], tmp=chunk_buffer[0:n,:])
+    
+    # transform the histograms of grey levels in the same way
+    if stats is not None and update_stats:
+        stats.update(rescale_stats(stats, dark_limit, light_limit))
     
     ## Reshape histogram ----
     # maxv = img.max()
@@ -44,3 +94,78 @@ def enhance(img, cfg):
     # plt.show()
     
     return img_eq
+
+def enhance_limits(stats, cfg):
+    """
+    Compute the limits of the rescale of grey levels from their statistics
+
+    Args:
+        stats (dict): statistics of grey levels of a flat-fielded image, from
+            `image_stats()`.
+        cfg (dict): configuration options.
+
+    Returns:
+        float, float: grey levels which become black and white once enhanced.
+    """
+    thresholds = (cfg['enhance']['dark_threshold'], cfg['enhance']['light_threshold'])
+    dark_limit, light_limit = percentile(stats['image'], thresholds)
+    return(dark_limit, light_limit)
+
+def rescale_stats(stats, dark_limit, light_limit):
+    """
+    Transform statistics of grey levels as the grey levels are by `enhance()`
+
+    Args:
+        stats (dict): statistics of grey levels of an image, from
+            `image_stats()`.
+        dark_limit, light_limit (float): limits of the rescale.
+
+    Returns:
+        dict: statistics of grey levels of the enhanced image, without reading
+            it.
+    """
+    new_stats = {}
+    for name, hist in stats.items():
+        if 'neighbours' in hist:
+            # count the pixels again, interpolated from their rescaled
+            # neighbours, as they are when the enhanced image is shrunk
+            # NB: clipping grey levels changes the interpolated ones
+            new_stats[name] = recount(hist, lambda x: _rescale_intensity(x,
+                dark_limit, light_limit, out=np.empty_like(x),
+                tmp=np.empty(x.shape, dtype=compute_dtype(x.dtype))))
+        elif hist['discrete']:
+            # move the count of each level to the level it becomes
+            levels = np.arange(256, dtype=np.uint8)
+            lut = _rescale_intensity(levels, dark_limit, light_limit,
+                                     out=np.empty_like(levels), tmp=np.empty(256, dtype=np.float32))
+            counts = np.bincount(lut, weights=hist['counts'], minlength=256)
+            new_stats[name] = dict(hist, counts=counts.astype(hist['counts'].dtype))
+        else:
+            # or move the limits of bins
+            edges = hist['edges']
+            edges = _rescale_intensity(edges, dark_limit, light_limit,
+                                       out=np.empty_like(edges), tmp=np.empty_like(edges))
+            new_stats[name] = dict(hist, edges=edges)
+    return(new_stats)
+
+def _rescale_intensity(x, dark_limit, light_limit, out, tmp):
+    """
+    Rescale grey levels between two limits to [0,1]
+
+    Args:
+        x (ndarray): grey levels (floats in [0,1] or uint8 in [0,255]).
+        dark_limit, light_limit (float): grey levels, in [0,1], which become
+            0 and 1; those outside of them are clipped.
+        out (ndarray): array of the shape and type of `x`, in which to store
+            the result (which can be `x` itself).
+        tmp (ndarray): array of floats of the shape of `x`, used as temporary
+            storage; float32 for uint8, of the type of `x` otherwise.
+
+    Returns:
+        ndarray: `out`.
+    """
+    x = to_float(x, out=tmp)
+    np.clip(x, dark_limit, light_limit, out=x)
+    x -= dark_limit
+    x /= (light_limit - dark_limit)
+    return(from_float(x, out))
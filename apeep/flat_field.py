@@ -0,0 +1,653 @@
+import logging
+
+import cv2
+import numpy as np
+
+import apeep.timers as t
+from apeep.pixels import to_float, from_float
+
+# from ipdb import set_trace as db
+
+# number of lines processed at once, to keep temporary arrays in the CPU cache
+chunk_lines = 128
+# number of lines in the parts of a chunk in which the 'median' method counts
+# pixels, to find the columns in which the median may move
+part_lines = 32
+
+# values of 8-bit grey levels in [0,1]
+grey_levels = np.arange(256) / 255.
+# values by which to divide pixels for each median grey level
+# NB: level 0 is replaced by level 1, so that the columns which are black over
+#     the whole window do not give infinite values
+median_levels = np.maximum(grey_levels, grey_levels[1])
+
+def init_flat_field(window, method='ema', window_size=8000, step=1,
+                    profile=None, refresh=0, tolerance=0):
+    """
+    Initialise flat-fielding
+    
+    Args:
+        window (ndarray): first `window_size` lines of the stream (of floats
+            in [0,1] or of uint8 in [0,255]), used to compute the initial
+            moving average line.
+        method (str): how the moving average is computed.
+            - 'ema' uses an exponential decay approximation of the mean over
+              `window_size` lines, which does not need to store the window.
+            - 'boxcar' computes the exact mean over the last `window_size`
+              lines, which requires storing them.
+            - 'median' computes the exact (lower) median over the last
+              `window_size` lines, of the grey levels quantised on 8 bits,
+              which avoids white streaks after dark objects; a median of 0 is
+              counted as 1/255.
+            In those cases, the moving average is computed line by line (or
+            step by step), exactly, even though data is processed in large
+            blocks.
+            - 'static' uses a fixed profile, the mean of `window` or
+              `profile`, which is only recomputed every `refresh` lines or
+              when the background drifts by more than `tolerance`.
+        window_size (int): size of the moving window, in lines.
+        step (int): number of lines by which the moving window advances; it
+            should divide `window_size`.
+        profile (ndarray): for the 'static' method, a precomputed profile, used
+            instead of the mean of `window`.
+        refresh (int): for the 'static' method, number of lines after which
+            the profile is recomputed, over the last `window_size` lines;
+            0 to never recompute it.
+        tolerance (float): for the 'static' method, median relative change of
+            the mean of columns above which the profile is recomputed; 0 to
+            never recompute it.
+    
+    Returns:
+        dict: the state of flat-fielding, to be passed to `flat_field()`, containing
+            method (str), window_size (int), step (int): as above.
+            mavg (ndarray): the current moving average line.
+            and, for the 'boxcar' and 'median' methods
+            history (ndarray): the last `window_size` lines, in a circular
+                buffer (for the 'median' method, quantised as uint8 and
+                transposed, of shape (number of columns, `window_size`)).
+            pos (int): index of the oldest line in `history`.
+            and, for the 'median' method
+            median (ndarray): grey level of the median of each column.
+            below (ndarray): number of pixels darker than the median in each
+                column.
+            at (ndarray): number of pixels at the median in each column.
+            and, for the 'static' method
+            refresh (int), tolerance (float): as above.
+            age (int): number of lines since the profile was computed.
+    """
+    # get general logger
+    log = logging.getLogger()
+    
+    window_size = int(window_size)
+    step = int(step)
+    if window_size % step != 0:
+        raise ValueError('`step` should divide `window_size`')
+    
+    # convert raw grey levels to floats in [0,1]
+    if window.dtype == np.uint8:
+        window = to_float(window[0:window_size,:])
+    
+    state = {
+        'method': method,
+        'window_size': window_size,
+        'step': step,
+        'mavg': np.mean(window, axis=0) # columnw-wise mean
+    }
+    
+    if method == 'ema':
+        pass
+    elif method == 'boxcar':
+        state['history'] = window[0:window_size,:].copy()
+        state['pos'] = 0
+    elif method == 'median':
+        history = quantise(window[0:window_size,:])
+        n_cols = history.shape[1]
+        # compute the histogram of each column
+        idx = history + np.arange(n_cols) * 256
+        hist = np.bincount(idx.ravel(), minlength=n_cols * 256)
+        hist = hist.reshape((n_cols, 256))
+        # find the median from the cumulative histogram
+        cum_hist = np.cumsum(hist, axis=1)
+        median = np.argmax(cum_hist > (window_size - 1) // 2, axis=1)
+        cols = np.arange(n_cols)
+        # NB: use small integers, which are faster to update
+        dtype = np.int16 if window_size < 2**15 else np.int32
+        at = hist[cols, median].astype(dtype)
+        below = (cum_hist[cols, median] - at).astype(dtype)
+        state.update({
+            # NB: store each column of the window contiguously, so that the
+            #     columns in which the median moves can be read quickly
+            'history': cv2.transpose(history),
+            'pos': 0,
+            'median': median,
+            'below': below,
+            'at': at,
+            'mavg': median_levels[median]
+        })
+    elif method == 'static':
+        if profile is not None:
+            profile = np.asarray(profile, dtype=float)
+            if profile.shape != state['mavg'].shape:
+                raise ValueError('`profile` should have ' + str(state['mavg'].size) + ' columns')
+            state['mavg'] = profile
+        state.update({
+            'refresh': int(refresh),
+            'tolerance': float(tolerance),
+            'age': 0
+        })
+    else:
+        raise ValueError('unknown `method` argument')
+    
+    log.debug('moving average line initialised, mean value = ' + str(np.mean(state['mavg'])))
+    
+    return(state)
+
+@t.timer
+def flat_field(data, state, out=None):
+    """
+    Flat-field a block of lines
+    
+    Divides each line by the moving average line, updated every `step` lines,
+    exactly as if lines were processed one step at a time, but working on the
+    whole block at once.
+    
+    Args:
+        data (ndarray): block of lines (of floats in [0,1] or of uint8 in
+            [0,255]), whose number of lines is a multiple of `step`.
+        state (dict): state of flat-fielding, from `init_flat_field()`; it is
+            updated in place.
+        out (ndarray): C-contiguous array in which to store the result; should
+            not overlap with `data`. When it is of type uint8, the result is
+            clipped to [0,1] and stored in [0,255].
+    
+    Returns:
+        ndarray: flat-fielded block of lines (of the type of `out`, by default
+            of `data`, computed in float32 for uint8).
+    """
+    step = state['step']
+    n_lines, n_cols = data.shape
+    if n_lines % step != 0:
+        raise ValueError('the number of lines in `data` should be a multiple of `step`')
+    
+    if out is None:
+        out = np.empty_like(data)
+    elif not out.flags['C_CONTIGUOUS']:
+        raise ValueError('`out` should be C-contiguous')
+    
+    if state['method'] == 'static':
+        _update_profile(data, state)
+    
+    if data.dtype != np.uint8 and out.dtype != np.uint8:
+        _flat_field(data, state, out)
+    else:
+        # convert 8-bit data to and from floats chunk by chunk, so that
+        # temporary arrays stay in the CPU cache
+        chunk_size = step * max(1, chunk_lines // step)
+        data_f = np.empty((chunk_size, n_cols), dtype=np.float32)
+        out_f = np.empty((chunk_size, n_cols), dtype=np.float32)
+        for i in range(0, n_lines, chunk_size):
+            n = min(chunk_size, n_lines - i)
+            chunk = to_float(data[i:i+n,:], out=data_f[0:n,:])
+            if out.dtype == np.uint8:
+                _flat_field(chunk, state, out_f[0:n,:])
+                from_float(out_f[0:n,:], out[i:i+n,:])
+            else:
+                _flat_field(chunk, state, out[i:i+n,:])
+    
+    return(out)
+
+def _flat_field(data, state, out):
+    if state['method'] == 'ema':
+        _flat_field_ema(data, state, out)
+    elif state['method'] == 'boxcar':
+        _flat_field_boxcar(data, state, out)
+    elif state['method'] == 'median':
+        _flat_field_median(data, state, out)
+    elif state['method'] == 'static':
+        _flat_field_static(data, state, out)
+    pass
+
+def _flat_field_ema(data, state, out):
+    step = state['step']
+    window_size = state['window_size']
+    decay = 1 - step / window_size
+    
+    # process the block in chunks small enough to stay in the CPU cache
+    chunk_size = step * max(1, chunk_lines // step)
+    for i in range(0, data.shape[0], chunk_size):
+        chunk = data[i:i+chunk_size,:]
+        out_chunk = out[i:i+chunk_size,:]
+        n_steps = chunk.shape[0] // step
+        
+        # sum lines within each step
+        steps = chunk.reshape((n_steps, step, -1))
+        if step == 1:
+            sums = chunk
+            # NB: store the moving average at each step directly in the output
+            mavg = out_chunk
+        else:
+            sums = np.sum(steps, axis=1)
+            mavg = sums
+        
+        # update the moving average at each step
+        #   mavg[k] = mavg[k-1] + (sums[k] - mavg[k-1] * step) / window_size
+        #           = decay * mavg[k-1] + sums[k] / window_size
+        # which is a first order recursive filter over steps
+        np.multiply(sums, 1 / window_size, out=mavg)
+        _recursive_filter(mavg, decay, state['mavg'])
+        state['mavg'] = mavg[-1,:].copy()
+        
+        # compute flat-fielding
+        np.divide(steps, mavg[:,np.newaxis,:], out=out_chunk.reshape(steps.shape))
+    pass
+
+def _flat_field_boxcar(data, state, out):
+    step = state['step']
+    window_size = state['window_size']
+    history = state['history']
+    
+    # process the block in chunks small enough to stay in the CPU cache
+    chunk_size = step * max(1, chunk_lines // step)
+    i = 0
+    while i < data.shape[0]:
+        pos = state['pos']
+        # NB: do not go past the end of the circular buffer
+        n = min(chunk_size, window_size - pos, data.shape[0] - i)
+        chunk = data[i:i+n,:]
+        out_chunk = out[i:i+n,:]
+        n_steps = n // step
+        
+        # get the lines entering and leaving the window, step by step
+        entering = chunk.reshape((n_steps, step, -1))
+        leaving = history[pos:pos+n,:].reshape(entering.shape)
+        
+        # compute the difference between the sums of entering and leaving lines
+        if step == 1:
+            # NB: store the moving average at each step directly in the output
+            mavg = out_chunk
+            np.subtract(chunk, history[pos:pos+n,:], out=mavg)
+        else:
+            mavg = np.sum(entering, axis=1, dtype=np.float64)
+            mavg -= np.sum(leaving, axis=1, dtype=np.float64)
+        mavg *= 1 / window_size
+        
+        # replace the oldest lines by the new ones in the history
+        history[pos:pos+n,:] = chunk
+        state['pos'] = (pos + n) % window_size
+        
+        # compute the mean over the window at each step, from a running
+        # cumulative sum of these differences
+        _recursive_filter(mavg, 1., state['mavg'])
+        if state['pos'] == 0:
+            # NB: recompute the mean from the lines in the window once they
+            #     have all been replaced, so that rounding errors of the
+            #     running sum do not accumulate
+            state['mavg'] = np.mean(history, axis=0)
+        else:
+            state['mavg'] = mavg[-1,:].copy()
+        
+        # compute flat-fielding
+        np.divide(entering, mavg[:,np.newaxis,:],
+                  out=out_chunk.reshape(entering.shape))
+        
+        i += n
+    pass
+
+def _flat_field_median(data, state, out):
+    step = state['step']
+    window_size = state['window_size']
+    history = state['history']
+    median = state['median']
+    below = state['below']
+    at = state['at']
+    # rank of the median in the window
+    rank = (window_size - 1) // 2
+    # NB: divide in the type of the data, as for the other methods
+    levels = median_levels.astype(data.dtype)
+    
+    # process the block in chunks small enough to stay in the CPU cache
+    chunk_size = step * max(1, chunk_lines // step)
+    i = 0
+    while i < data.shape[0]:
+        pos = state['pos']
+        # NB: do not go past the end of the circular buffer
+        n = min(chunk_size, window_size - pos, data.shape[0] - i)
+        chunk = data[i:i+n,:]
+        out_chunk = out[i:i+n,:]
+        n_steps = n // step
+        
+        # compute flat-fielding with the median at the start of the chunk
+        # NB: do it while the chunk is in the CPU cache
+        np.divide(chunk, levels[median], out=out_chunk)
+        
+        # get the lines entering and leaving the window
+        entering = quantise(chunk)
+        # NB: cv2 transposes much faster than numpy
+        leaving = cv2.transpose(history[:,pos:pos+n])
+        
+        # count the pixels darker than and at the median among them, in a few
+        # parts of the chunk
+        # NB: the histograms of the columns are not kept, because updating
+        #     them pixel by pixel is much slower than these comparisons
+        m = median.astype(np.uint8)
+        entering_below = _count_parts(entering < m)
+        entering_not_above = _count_parts(entering <= m)
+        leaving_below = _count_parts(leaving < m)
+        leaving_not_above = _count_parts(leaving <= m)
+        
+        # the median cannot move down if, even when all darker pixels of a
+        # part enter the window before any leaves it, no more than `rank`
+        # pixels are darker than it
+        can_move = below + np.max(entering_below[1:] - leaving_below[:-1], axis=0) > rank
+        # and conversely for moving up
+        can_move |= below + at + np.min(entering_not_above[:-1] - leaving_not_above[1:], axis=0) <= rank
+        cols = np.flatnonzero(can_move)
+        leaving_cols = history[cols,pos:pos+n]
+        
+        # update the number of pixels darker than and at the median
+        change_below = entering_below[-1] - leaving_below[-1]
+        below += change_below
+        at += entering_not_above[-1] - leaving_not_above[-1] - change_below
+        
+        # replace the oldest lines by the new ones in the history
+        cv2.transpose(entering, dst=history[:,pos:pos+n])
+        state['pos'] = (pos + n) % window_size
+        
+        # compute the median at each step, in the columns where it moves
+        moving, medians, moving_below, moving_at = _running_median(
+            history, cols, median[cols], below[cols], at[cols],
+            history[cols,pos:pos+n], leaving_cols, window_size, step)
+        
+        # correct flat-fielding where the median moves
+        if len(moving) > 0:
+            out_chunk[:,moving] = (
+                chunk[:,moving].reshape((n_steps, step, -1)) /
+                levels[medians[:,np.newaxis,:]]
+            ).reshape((n, -1))
+        
+        # and where it moved
+        median[moving] = medians[-1,:]
+        below[moving] = moving_below
+        at[moving] = moving_at
+        
+        i += n
+    
+    state['mavg'] = median_levels[median]
+    pass
+
+def _running_median(history, cols, median, below, at, entering, leaving,
+                    window_size, step):
+    """
+    Compute the median of each column, at each step of a chunk of lines
+    
+    The median can only move by a few grey levels during a chunk, and only in
+    a few columns. So the number of pixels darker than the grey levels around
+    the median is only counted in those columns, at each step.
+    
+    Args:
+        history (ndarray): window at the end of the chunk, quantised, with the
+            pixels of each column in a row.
+        cols (ndarray): index of the columns in which the median may move.
+        median (ndarray): grey level of the median of those columns, at the
+            start of the chunk.
+        below (ndarray): number of pixels darker than `median`, at the end of
+            the chunk.
+        at (ndarray): number of pixels at `median`, at the end of the chunk.
+        entering, leaving (ndarray): quantised pixels entering and leaving the
+            window during the chunk, in those columns, transposed like
+            `history`.
+        window_size (int): size of the window, in lines.
+        step (int): number of lines in each step.
+    
+    Returns:
+        ndarray: index of the columns in which the median moves.
+        ndarray: grey level of the (lower) median of those columns, at the end
+            of each step.
+        ndarray, ndarray: number of pixels darker than and at the median of
+            those columns, at the end of the chunk.
+    """
+    n_steps = entering.shape[1] // step
+    # rank of the median in the window
+    rank = (window_size - 1) // 2
+    
+    # keep the columns where, at the end of a step, the number of pixels
+    # darker than the median exceeds the rank, or the number of pixels darker
+    # than or at it does not
+    m = median[:,np.newaxis].astype(np.uint8)
+    count_below = _running_count(below, entering < m, leaving < m, step)
+    count_not_above = _running_count(below + at, entering <= m, leaving <= m, step)
+    down = count_below > rank
+    up = count_not_above <= rank
+    moves = np.any(down, axis=1) | np.any(up, axis=1)
+    cols = cols[moves]
+    if len(cols) == 0:
+        empty = np.empty(0, dtype=np.int32)
+        return(cols, np.empty((n_steps, 0), dtype=median.dtype), empty, empty)
+    median = median[moves]
+    entering = entering[moves]
+    leaving = leaving[moves]
+    down = down[moves]
+    up = up[moves]
+    
+    # shift of the median from its level at the start of the chunk, at each
+    # step, and numbers of pixels darker than or at the levels around it, at
+    # the end of the chunk
+    shift = up.astype(np.int32) - down
+    ends = [count_below[moves,-1], count_not_above[moves,-1]]
+    
+    # count the pixels darker than or at lower levels, in the columns where
+    # the median goes below the previous one, and at higher levels, in the
+    # columns where it goes above the previous one, until it stays between
+    # them
+    # NB: count both in one go; the median moves by one more level at each
+    #     step where it goes past the new ones
+    low = np.flatnonzero(np.any(down, axis=1))
+    high = np.flatnonzero(np.any(up, axis=1))
+    depth = 0
+    while len(low) + len(high) > 0:
+        depth += 1
+        k = np.concatenate((low, high))
+        levels = np.concatenate((median[low] - 1 - depth, median[high] + depth))
+        count = _count_darker(history[cols[k]], entering[k], leaving[k],
+                              levels, step)
+        down = count[:len(low)] > rank
+        up = count[len(low):] <= rank
+        shift[low] -= down
+        shift[high] += up
+        end = np.zeros((2, len(cols)), dtype=count.dtype)
+        end[0,low] = count[:len(low),-1]
+        end[1,high] = count[len(low):,-1]
+        ends.insert(0, end[0])
+        ends.append(end[1])
+        low = low[np.any(down, axis=1)]
+        high = high[np.any(up, axis=1)]
+    
+    # get the median at each step and the numbers of pixels darker than and
+    # at it, at the end
+    medians = (median[:,np.newaxis] + shift).T
+    ends = np.stack(ends)
+    # NB: ends[depth+1] is the count at the median at the start of the chunk
+    idx = depth + 1 + shift[:,-1]
+    rows = np.arange(len(cols))
+    below = ends[idx - 1,rows]
+    at = ends[idx,rows] - below
+    
+    return(cols, medians, below, at)
+
+def _count_darker(window, entering, leaving, levels, step):
+    """
+    Count the pixels darker than or at a grey level, at each step of a chunk
+    
+    Args:
+        window (ndarray): window at the end of the chunk, quantised, with the
+            pixels of each column in a row.
+        entering, leaving (ndarray): quantised pixels entering and leaving the
+            window during the chunk, transposed like `window`.
+        levels (ndarray): grey level in each column; below 0, no pixel is
+            counted.
+        step (int): number of lines in each step.
+    
+    Returns:
+        ndarray: number of pixels darker than or at `levels` in each column
+            (row), at the end of each step (column).
+    """
+    # NB: np.clip is slow on small arrays
+    level = np.minimum(np.maximum(levels, 0), 255).astype(np.uint8)
+    level = level[:,np.newaxis]
+    count = _count(window <= level, axis=1)
+    count = _running_count(count, entering <= level, leaving <= level, step)
+    count[levels < 0] = 0
+    return(count)
+
+def _running_count(count, entering, leaving, step):
+    """
+    Compute a number of pixels in the window at each step of a chunk of lines
+    
+    Args:
+        count (ndarray): number of pixels in each column at the end of the
+            chunk.
+        entering, leaving (ndarray): whether each pixel entering and leaving
+            the window during the chunk is counted, with the pixels of each
+            column in a row.
+        step (int): number of lines in each step.
+    
+    Returns:
+        ndarray: number of pixels in each column (row), at the end of each
+            step (column).
+    """
+    n_lines = entering.shape[1]
+    # compute the cumulative sum of the difference between entering and
+    # leaving pixels, along all rows at once
+    # NB: cv2 computes cumulative sums (of an image, along both axes) much
+    #     faster than numpy, but only of positive numbers
+    cum = cv2.integral(entering.reshape((1, -1)).view(np.uint8))[1]
+    cum -= cv2.integral(leaving.reshape((1, -1)).view(np.uint8))[1]
+    # the count at the end of each step is then the count at the end of the
+    # chunk minus the difference over the following steps
+    end = cum[n_lines::n_lines]
+    steps = cum[1:].reshape(entering.shape)[:,step-1::step]
+    return(steps + (count - end)[:,np.newaxis])
+
+def _update_profile(data, state):
+    """
+    Recompute the profile of the 'static' method, if needed, in place
+    
+    Args:
+        data (ndarray): block of lines about to be flat-fielded.
+        state (dict): state of flat-fielding.
+    
+    Returns:
+        Nothing
+    """
+    # get general logger
+    log = logging.getLogger()
+    
+    # NB: the mean of raw grey levels is converted to [0,1]
+    scale = 255. if data.dtype == np.uint8 else 1.
+    
+    # check whether the profile should be recomputed
+    # NB: this is checked once per block, not line by line
+    update = state['refresh'] > 0 and state['age'] >= state['refresh']
+    if not update and state['tolerance'] > 0:
+        # estimate the mean of columns from a subset of lines, which is
+        # enough to detect a drift, and compare it with the profile
+        # NB: the median is robust to dark objects in some columns
+        drift = np.median(np.abs(np.mean(data[::16,:], axis=0) / scale / state['mavg'] - 1))
+        update = drift > state['tolerance']
+        if update:
+            log.debug('background drifted by ' + str(round(drift, 4)))
+    
+    if update:
+        state['mavg'] = np.mean(data[-state['window_size']:,:], axis=0) / scale
+        state['age'] = 0
+        log.debug('profile recomputed, mean value = ' + str(np.mean(state['mavg'])))
+    state['age'] += data.shape[0]
+    pass
+
+def _flat_field_static(data, state, out):
+    np.divide(data, state['mavg'], out=out)
+    pass
+
+def _count_parts(x):
+    """
+    Count the True elements in each column, up to the end of each part of
+    `part_lines` lines
+
+    Args:
+        x (ndarray): 2D array of bool.
+
+    Returns:
+        ndarray: int32 array of the counts, of shape (number of parts + 1,
+            number of columns), whose first row is zero.
+    """
+    n_lines, n_cols = x.shape
+    n_full = n_lines // part_lines
+    counts = np.zeros((-(-n_lines // part_lines) + 1, n_cols), dtype=np.int32)
+    # count them in each part
+    # NB: numpy sums much faster in 8-bit integers, which hold the count of
+    #     a part as long as it has less than 256 lines
+    x = x.view(np.uint8)
+    counts[1:n_full+1] = np.add.reduce(
+        x[0:n_full*part_lines].reshape((n_full, part_lines, n_cols)),
+        axis=1, dtype=np.uint8)
+    if n_full < len(counts) - 1:
+        counts[-1] = np.add.reduce(x[n_full*part_lines:], axis=0, dtype=np.uint8)
+    # then up to the end of each part
+    # NB: np.cumsum is slow along a few rows
+    for k in range(2, len(counts)):
+        counts[k] += counts[k-1]
+    return(counts)
+
+def _count(x, axis):
+    """
+    Count true elements along an axis of a 2D boolean array
+    
+    Args:
+        x (ndarray): 2D boolean array.
+        axis (int): axis along which to count.
+    
+    Returns:
+        ndarray: array of int32 of counts.
+    """
+    # NB: cv2 sums 8-bit integers much faster than numpy
+    return(cv2.reduce(x.view(np.uint8), axis, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel())
+
+def quantise(x):
+    """
+    Quantise grey levels in [0,1] on 8 bits
+    
+    Args:
+        x (ndarray): array of floats in [0,1].
+    
+    Returns:
+        ndarray: array of uint8 in [0,255].
+    """
+    # NB: cv2 rounds (to the nearest level, computing in single precision)
+    #     several times faster than numpy
+    return(cv2.convertScaleAbs(x, alpha=255))
+
+def _recursive_filter(x, decay, x0):
+    """
+    Compute x[k] = decay * x[k-1] + x[k] along the first axis, in place
+    
+    Args:
+        x (ndarray): 2D array, modified in place.
+        decay (float): weight of the previous line.
+        x0 (ndarray): line preceding the first line of `x`.
+    
+    Returns:
+        Nothing
+    """
+    # NB: one line at a time, this only performs two operations per line, in
+    #     a preallocated buffer, and is faster than np.cumsum (and
+    #     scipy.signal.lfilter) along the first axis of a C-contiguous array
+    tmp = np.empty_like(x0)
+    prev = x0
+    for k in range(x.shape[0]):
+        if decay == 1:
+            x[k] += prev
+        else:
+            np.multiply(prev, decay, out=tmp)
+            x[k] += tmp
+        prev = x[k]
+    pass
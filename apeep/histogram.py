@@ -0,0 +1,287 @@
+import numpy as np
+
+from apeep.pixels import to_float
+
+# from ipdb import set_trace as db
+
+# The distribution of grey levels of an image is summarised by a histogram,
+# from which percentiles and thresholds are read without sorting pixels. The
+# pixels counted are those of the image shrunk by linear interpolation, from
+# which percentiles are computed otherwise, so that both give the same result.
+# Raw grey levels (uint8) which are not interpolated are counted exactly, one
+# bin per level; floats are counted in `n_bins` bins of equal width, over
+# their range.
+
+# number of bins of the histograms of floats
+n_bins = 4096
+
+def grey_histogram(img, stride=5):
+    """
+    Compute the histogram of grey levels of an image
+
+    Args:
+        img (ndarray): image of floats in [0,1] or of uint8 in [0,255].
+        stride (int): the pixels counted are those of the image shrunk by a
+            factor `stride`, as by `skimage.transform.rescale(img, 1/stride,
+            anti_aliasing=False)`; only the pixels around them are read.
+
+    Returns:
+        dict: containing
+            counts (ndarray): number of pixels in each bin.
+            edges (ndarray): limits of the bins, of grey levels in [0,1].
+            discrete (bool): whether all pixels of a bin have the same grey
+                level, the centre of the bin, which is the case for uint8
+                when no pixel is interpolated.
+    """
+    return(_histogram(_interpolate(_neighbours(img, stride))))
+
+def image_stats(img, stride=5):
+    """
+    Compute the statistics of grey levels of an image
+
+    They are computed once per image, from the pixels of the image and of its
+    central band shrunk as in `grey_histogram()`, and then used by all steps
+    which need the distribution of grey levels, without reading pixels again.
+
+    Args:
+        img (ndarray): image of floats in [0,1] or of uint8 in [0,255], in
+            acquisition orientation (one scanned line per row).
+        stride (int): factor by which the image is shrunk before counting its
+            pixels, as in `grey_histogram()`.
+
+    Returns:
+        dict: containing histograms, as returned by `grey_histogram()`
+            image: of the whole image.
+            band: of the central band of the image, i.e. of the central half
+                of the scanned lines, which has fewer artifacts; it also
+                contains the pixels from which those counted are
+                interpolated, in `neighbours`, so that it can be counted again
+                once they are transformed, with `recount()`.
+    """
+    # NB: the band is shrunk on its own, as `segmentation_threshold()` does,
+    #     so its pixels are interpolated at other positions
+    crop = img.shape[1] // 4
+    band = _neighbours(img[:,crop:3*crop], stride)
+    stats = {
+        'image': _histogram(_interpolate(_neighbours(img, stride))),
+        'band': dict(_histogram(_interpolate(band)), neighbours=band)
+    }
+    return(stats)
+
+def recount(hist, transform):
+    """
+    Count the pixels of a histogram again, once their grey levels are transformed
+
+    The pixels are interpolated again from their transformed neighbours, as
+    they would be when shrinking the transformed image; this differs from
+    transforming the interpolated pixels when the transformation is not
+    linear, e.g. when it clips grey levels.
+
+    Args:
+        hist (dict): histogram with the neighbours of its pixels, e.g. the band
+            of `image_stats()`.
+        transform (function): function which takes an image of grey levels and
+            returns the transformed image, of floats in [0,1] or uint8 in
+            [0,255].
+
+    Returns:
+        dict: histogram of the transformed pixels, with their neighbours.
+    """
+    neighbours = [(transform(pixels), w_rows, w_cols)
+                  for pixels, w_rows, w_cols in hist['neighbours']]
+    return(dict(_histogram(_interpolate(neighbours)), neighbours=neighbours))
+
+def _neighbours(img, stride):
+    """
+    Find the pixels from which those of an image shrunk as
+    `skimage.transform.rescale(img, 1/stride, anti_aliasing=False)` does are
+    interpolated
+
+    Each pixel of the shrunk image is interpolated linearly between the four
+    pixels of `img` around its position; only these pixels are read.
+
+    Returns:
+        list: of (pixels, w_rows, w_cols) tuples, for each of the four
+            neighbours which contributes: the neighbour of each pixel of the
+            shrunk image, with its layout, and its weight, as the product of
+            weights along rows and columns.
+    """
+    rows, w_rows = _positions(img.shape[0], 1 / stride)
+    cols, w_cols = _positions(img.shape[1], 1 / stride)
+    neighbours = []
+    for d_row, w_row in ((0, 1 - w_rows), (1, w_rows)):
+        for d_col, w_col in ((0, 1 - w_cols), (1, w_cols)):
+            # NB: skip the neighbours which do not contribute, which are all
+            #     of them along a dimension shrunk by an integer factor
+            if np.any(w_row) and np.any(w_col):
+                neighbours.append((img[np.ix_(rows + d_row, cols + d_col)], w_row, w_col))
+    return(neighbours)
+
+def _interpolate(neighbours):
+    """
+    Interpolate the pixels of a shrunk image from their neighbours
+
+    Returns:
+        ndarray: shrunk image, of uint8 when the neighbours are and no pixel
+            needs to be interpolated, of floats in [0,1] otherwise.
+    """
+    if len(neighbours) == 1:
+        return(neighbours[0][0])
+    x = 0
+    for pixels, w_rows, w_cols in neighbours:
+        x = x + pixels * np.outer(w_rows, w_cols)
+    if neighbours[0][0].dtype == np.uint8:
+        x /= 255
+    return(x)
+
+def _positions(n, scale):
+    """
+    Find the pixels around which those of a dimension of size `n` rescaled by
+    `scale` are interpolated
+
+    Returns:
+        ndarray: index of the pixel before the position of each pixel.
+        ndarray: weight of the pixel after it, in [0,1].
+    """
+    n_out = max(int(np.round(scale * n)), 1)
+    # NB: the centres of the first and last pixels stay aligned
+    position = (np.arange(n_out) + 0.5) * (n / n_out) - 0.5
+    position = np.clip(position, 0, n - 1)
+    before = np.minimum(np.floor(position).astype(np.intp), max(n - 2, 0))
+    return(before, position - before)
+
+def _histogram(x):
+    """
+    Count the pixels of an image in the bins of a histogram
+
+    Returns:
+        dict: histogram, as returned by `grey_histogram()`.
+    """
+    if x.dtype == np.uint8:
+        bins = x
+        edges = (np.arange(257) - 0.5) / 255
+        discrete = True
+    else:
+        x = to_float(x)
+        low = float(x.min())
+        high = float(x.max())
+        # NB: give some width to the bins of a uniform image
+        scale = n_bins / max(high - low, np.finfo(np.float32).eps)
+        bins = np.multiply(np.subtract(x, low), scale).astype(np.intp)
+        np.minimum(bins, n_bins - 1, out=bins)
+        edges = low + np.arange(n_bins + 1) / scale
+        discrete = False
+    counts = np.bincount(bins.ravel(), minlength=len(edges) - 1)
+    return({'counts': counts, 'edges': edges, 'discrete': discrete})
+
+def percentile(hist, q):
+    """
+    Compute percentiles of grey levels from their histogram
+
+    Percentiles are interpolated linearly between the pixels around them, as
+    `np.percentile()` does. The grey level of these pixels is exact when the
+    histogram is discrete; otherwise, pixels are considered to be evenly
+    spread within their bin, so the result is precise to the width of a bin.
+
+    Args:
+        hist (dict): histogram, from `grey_histogram()`.
+        q (float or sequence of floats): percentiles, in [0,100].
+
+    Returns:
+        float or ndarray: grey levels of these percentiles, in [0,1].
+    """
+    counts = hist['counts']
+    cum_counts = np.cumsum(counts)
+    n = cum_counts[-1]
+
+    # rank of the percentiles among the pixels
+    rank = np.asarray(q, dtype=float) / 100 * (n - 1)
+    below = np.floor(rank)
+    above = np.minimum(below + 1, n - 1)
+    # interpolate between the pixels at these ranks
+    v_below = _grey_level(hist, cum_counts, below)
+    v_above = _grey_level(hist, cum_counts, above)
+    return(v_below + (rank - below) * (v_above - v_below))
+
+def _grey_level(hist, cum_counts, rank):
+    # find the bin of the pixel of this rank
+    b = np.searchsorted(cum_counts, rank, side='right')
+    edges = hist['edges']
+    if hist['discrete']:
+        return((edges[b] + edges[b+1]) / 2)
+    else:
+        # and its position within the bin
+        counts = hist['counts']
+        position = (rank - (cum_counts[b] - counts[b]) + 0.5) / counts[b]
+        value = edges[b] + position * (edges[b+1] - edges[b])
+        # NB: the limits of the histogram are the extreme grey levels
+        value = np.where(rank == 0, edges[0], value)
+        value = np.where(rank == cum_counts[-1] - 1, edges[-1], value)
+        return(value)
+
+def otsu(hist):
+    """
+    Compute Otsu's threshold from a histogram of grey levels
+
+    This is `skimage.filters.threshold_otsu()`, computed on the histogram
+    rather than on the image; the pixels of each bin are considered to be at
+    its centre. When the bins of a histogram of floats span the range of the
+    pixels, as those of `grey_histogram()`, each one falls within one of the
+    256 bins of skimage and the result is the same.
+
+    Args:
+        hist (dict): histogram, from `grey_histogram()`.
+
+    Returns:
+        float: grey level of the threshold, in [0,1], the centre of a bin.
+    """
+    counts = hist['counts']
+    edges = hist['edges']
+    centres = (edges[:-1] + edges[1:]) / 2
+    # find the range of grey levels present: the centres of the extreme levels
+    # or the outer limits of the extreme bins of floats
+    present = np.flatnonzero(counts)
+    if hist['discrete']:
+        low = centres[present[0]]
+        high = centres[present[-1]]
+    else:
+        low = edges[present[0]]
+        high = edges[present[-1] + 1]
+    # count pixels in 256 bins over this range, as skimage does
+    # NB: bins of a transformed histogram can have the same centre
+    centres = centres[present]
+    counts = counts[present]
+    if low == high:
+        return(low)
+    bins = np.clip(((centres - low) / (high - low) * 256).astype(np.intp), 0, 255)
+    counts = np.bincount(bins, weights=counts, minlength=256)
+    centres = low + (np.arange(256) + 0.5) * (high - low) / 256
+
+    # class probabilities and means for all possible thresholds
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * centres) / weight1
+    mean2 = (np.cumsum((counts * centres)[::-1]) / weight2[::-1])[::-1]
+    # find the one which maximises the variance between classes
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return(centres[np.argmax(variance12)])
+
+def rebin(hist, edges):
+    """
+    Count the pixels of a histogram of floats in other bins
+
+    Args:
+        hist (dict): histogram, from `grey_histogram()`, of floats.
+        edges (ndarray): limits of the new bins; pixels outside of them are
+            counted in the first or last bin.
+
+    Returns:
+        dict: histogram with these bins, whose counts are floats; the pixels of
+            each bin of `hist` are considered to be evenly spread within it.
+    """
+    counts = hist['counts']
+    cum_counts = np.concatenate([[0], np.cumsum(counts)])
+    # number of pixels below each inner limit of the new bins
+    cum_counts = np.interp(edges[1:-1], hist['edges'], cum_counts)
+    new_counts = np.diff(np.concatenate([[0], cum_counts, [np.sum(counts)]]))
+    return({'counts': new_counts, 'edges': edges, 'discrete': False})
@@ -46,7 +46,7 @@ def _save(x, path):
     Save an array as an image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
     """
     lycon.save(path, x)
     pass
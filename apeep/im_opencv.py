@@ -28,13 +28,16 @@ def asimg(x):
     Convert numpy array into 8 bit image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
     
     Returns:
         ndarray: of uint8, in BGR order when the input is RGB.
     """
     # convert to 8 bit
-    x_uint8 = (x * 255).astype(np.uint8)
+    if x.dtype == np.uint8:
+        x_uint8 = x
+    else:
+        x_uint8 = (x * 255).astype(np.uint8)
     # if it is an RGB image, put the channels in BGR order, as expected by openCV
     if len(x.shape)==3 :
         x_uint8 = x_uint8[:,:,[2,1,0]]
@@ -45,7 +48,7 @@ def asimg(x):
 #     Display an array as image
 #
 #     Args:
-#         x (ndarray): numpy array of floats in [0,1].
+#         x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
 #     """
 #     cv2.imshow("Image", asimg(x))
 #     cv2.waitKey(0)
@@ -66,7 +69,7 @@ def _save(x, path):
     Save an array as an image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
     """
     cv2.imwrite(path, asimg(x))
     pass
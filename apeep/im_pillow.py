@@ -28,13 +28,16 @@ def asimg(x):
     Convert numpy array into 8 bit Pillow image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
     
     Returns:
         Image: Pillow image.
     """
     # convert to 8 bit
-    x_uint8 = (x * 255).astype(np.uint8)
+    if x.dtype == np.uint8:
+        x_uint8 = x
+    else:
+        x_uint8 = (x * 255).astype(np.uint8)
     # convert into a pillow image
     img = Image.fromarray(x_uint8)
     return(img)
@@ -44,7 +47,7 @@ def show(x):
     Display an array as image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
     """
     asimg(x).show()
     pass
@@ -59,7 +62,7 @@ def _save(x, path):
     Save an array as an image
     
     Args:
-        x (ndarray): numpy array of floats in [0,1].
+        x (ndarray): numpy array of floats in [0,1] or of uint8 in [0,255].
     """
     asimg(x).save(path)
     pass
@@ -2,11 +2,15 @@ import logging
 import os
 
 import skimage.measure
+import skimage.measure._regionprops
 import numpy as np
 import hashlib
 import pandas as pd
 
 import apeep.timers as t
+from apeep.pixels import to_float
+from apeep.buffers import buffer
+from apeep.orientation import orient, orient_regions, orient_props
 # import apeep.im_pillow as im
 import apeep.im_opencv as im
 # TODO homogenise the image saving with the rest
@@ -14,17 +18,26 @@ import apeep.im_opencv as im
 #from ipdb import set_trace as db
 
 @t.timer
-def measure(img, img_mask, image_info, props=['area']):
+def measure(img, img_labelled, image_info, props=['area'], top='right', pool=None, stats=None):
     """
     Measure particles
     
     Args:
-        img (ndarray): image (of type float)
-        img_mask (ndarray): masked image (mask with particles as 1 
-            and background as 0)
+        img (ndarray): image (of floats in [0,1] or of uint8 in [0,255]), in
+            acquisition orientation (one scanned line per row)
+        img_labelled (ndarray): labelled image (of integers, with particles
+            numbered consecutively from 1 and background as 0), from
+            `segment()`
         image_info (dict): dict containing avi_file, frame_nb and line_nb at the 
             beggining and the end of image
         properties (list): list of properties to extract from each particle
+        top (str): side of the scanned lines which is the top of the picture;
+            particles and their properties are oriented with the top up
+        pool (dict): pool of buffers, from `buffer_pool()`, from which to draw
+            intermediate images; when None, they are allocated.
+        stats (dict): statistics of the particles, from `segment()`; when
+            given, particles are found from their bounding box rather than
+            searched in the whole image.
     
     Returns:
         particles (dict): dict of ndarrays containing particles; the keys are
@@ -38,16 +51,36 @@ def measure(img, img_mask, image_info, props=['area']):
     # get general logger
     log = logging.getLogger()
     
-    # label particles
-    img_labelled = skimage.measure.label(img_mask, background=False, connectivity=2)
+    # measure grey levels in [0,1] whatever the type of the image
+    # NB: raw grey levels are converted to float32
+    if img.dtype == np.uint8:
+        img = to_float(img, out=buffer(pool, 'float', img.shape, np.float32))
     
     # initiate particle measurements
-    regions = skimage.measure.regionprops(label_image=img_labelled, intensity_image=img)
-    
-    # extract the content of the particles
-    particles = [get_particle_array(r) for r in regions]
+    if stats is None:
+        regions = skimage.measure.regionprops(label_image=img_labelled, intensity_image=img)
+    else:
+        # NB: this is skimage.measure.regionprops(), with the bounding boxes
+        #     of particles already known
+        regions = [skimage.measure._regionprops.RegionProperties(
+            (slice(b[0], b[2]), slice(b[1], b[3])), i + 1, img_labelled, img, True)
+            for i, b in enumerate(stats['bbox'])]
+    # number them as if the image was oriented with the top up
+    regions = orient_regions(regions, top=top)
+    
+    # extract the content of the particles, oriented with the top up
+    # NB: make them contiguous, to compute their checksum
+    particles = [np.ascontiguousarray(orient(get_particle_array(r), top=top)) for r in regions]
     # uniquement identify particles with their md5 checksum
-    particles = {hashlib.md5(p).hexdigest():p for p in particles}
+    ids = [hashlib.md5(p).hexdigest() for p in particles]
+    # NB: identical particles are common with quantised grey levels (e.g.
+    #     small uint8 particles); tell them apart by their position too
+    seen = set()
+    for i, r in enumerate(regions):
+        if ids[i] in seen:
+            ids[i] = hashlib.md5(particles[i].tobytes() + np.array(r.bbox, dtype=np.int64).tobytes()).hexdigest()
+        seen.add(ids[i])
+    particles = dict(zip(ids, particles))
     
     log.debug(f'{len(particles)} particles')
 
@@ -62,11 +95,16 @@ def measure(img, img_mask, image_info, props=['area']):
     #     intensity_image=img,
     #     properties=props
     # ))
+    if 'label' in particle_props:
+        particle_props['label'] = np.arange(1, len(regions)+1)
+    # convert positions to the oriented image
+    particle_props = orient_props(particle_props, regions, shape=img_labelled.shape, top=top)
     
     # fix orientation value by adding pi/2 to the skimage computed value
     particle_props['orientation'] = particle_props['orientation'] + np.pi/2
     
     # particle localisation within avi files
+    # NB: in the oriented image, columns are scanned lines
     # if image is from a single avi file
     if image_info['start_avi_file'] == image_info['end_avi_file']:
         
@@ -84,7 +122,7 @@ def measure(img, img_mask, image_info, props=['area']):
         # compute number of lines from the second avi file
         lines_after = image_info['end_frame_nb']*2048 + image_info['end_line_nb'] + 1
         # compute number of lines from the first avi file
-        output_size = img_labelled.shape[1]
+        output_size = img_labelled.shape[0]
         lines_before = output_size - lines_after
         
         # compute avi file and append to particles properties  
@@ -0,0 +1,163 @@
+import numpy as np
+
+# from ipdb import set_trace as db
+
+# Images are processed in acquisition orientation: one scanned line per row,
+# successive lines going down. They are only turned to the output convention,
+# where motion is from left to right and the top of the picture is up, when
+# they are written or when particles are extracted from them.
+
+# properties of particles which are measured in acquisition orientation and
+# are correct for the oriented particles: either they do not change with the
+# orientation or they are converted by `orient_props()`
+oriented_props = [
+    # converted
+    'bbox', 'centroid', 'weighted_centroid', 'centroid_weighted', 'orientation',
+    'moments_hu', 'weighted_moments_hu', 'moments_weighted_hu',
+    # invariant to rotations and mirror images
+    'label', 'area', 'bbox_area', 'area_bbox', 'convex_area', 'area_convex',
+    'filled_area', 'area_filled', 'eccentricity', 'equivalent_diameter',
+    'equivalent_diameter_area', 'euler_number', 'extent', 'feret_diameter_max',
+    'inertia_tensor_eigvals', 'major_axis_length', 'axis_major_length',
+    'minor_axis_length', 'axis_minor_length', 'max_intensity', 'intensity_max',
+    'mean_intensity', 'intensity_mean', 'min_intensity', 'intensity_min',
+    'perimeter', 'solidity'
+]
+
+def orient(img, top='right'):
+    """
+    View an image in acquisition orientation with its top up
+
+    Args:
+        img (ndarray): image in acquisition orientation.
+        top (str): side of the scanned lines which is the top of the picture,
+            'right' or 'left' (`acq > top` in the configuration).
+
+    Returns:
+        ndarray: view of `img` (not a copy), with motion from left to right.
+    """
+    if top == 'right':
+        img = np.rot90(img)
+    elif top == 'left':
+        img = img.T
+    else:
+        raise ValueError('unknown `top` argument')
+    return(img)
+
+def unorient(img, top='right'):
+    """
+    View an image with its top up in acquisition orientation
+
+    This is the reverse of `orient()`.
+
+    Args:
+        img (ndarray): image with motion from left to right.
+        top (str): side of the scanned lines which is the top of the picture.
+
+    Returns:
+        ndarray: view of `img` (not a copy), with one scanned line per row.
+    """
+    if top == 'right':
+        img = np.rot90(img, -1)
+    elif top == 'left':
+        img = img.T
+    else:
+        raise ValueError('unknown `top` argument')
+    return(img)
+
+def orient_regions(regions, top='right'):
+    """
+    Sort regions in the order in which they are labelled once oriented
+
+    Args:
+        regions (list): RegionProperties computed on an image in acquisition
+            orientation.
+        top (str): side of the scanned lines which is the top of the picture.
+
+    Returns:
+        list: `regions`, sorted by the position of their first pixel in the
+            oriented image, in raster order.
+    """
+    def first_pixel(r):
+        # the first row of the oriented region is its last column in
+        # acquisition orientation when top is on the right, its first column
+        # otherwise; its first pixel is the first one of this column
+        min_row, min_col, max_row, max_col = r.bbox
+        if top == 'right':
+            first_row = -max_col
+            column = r.image[:,-1]
+        else:
+            first_row = min_col
+            column = r.image[:,0]
+        return((first_row, min_row + np.argmax(column)))
+    return(sorted(regions, key=first_pixel))
+
+def orient_props(props, regions, shape, top='right'):
+    """
+    Convert particle properties measured in acquisition orientation
+
+    Args:
+        props (dict): particle properties, as returned by
+            `skimage.measure._regionprops._props_to_dict()` on an image in
+            acquisition orientation; modified in place.
+        regions (list): the RegionProperties these properties come from.
+        shape (tuple): shape of this image.
+        top (str): side of the scanned lines which is the top of the picture.
+
+    Returns:
+        dict: `props`, with the position (`bbox`, `centroid`,
+            `weighted_centroid`), the `orientation` and the reflection
+            sensitive Hu moment converted to the oriented image. Only the
+            properties in `oriented_props` are correct for the oriented
+            image; the other ones (e.g. `moments`, `coords`, `image`) would be
+            those of the particle in acquisition orientation.
+    """
+    width = shape[1]
+
+    # swap rows and columns
+    for prop in ['bbox', 'centroid', 'weighted_centroid', 'centroid_weighted']:
+        if prop + '-0' not in props:
+            continue
+        if prop == 'bbox':
+            row_cols = [('bbox-0', 'bbox-1'), ('bbox-2', 'bbox-3')]
+        else:
+            row_cols = [(prop + '-0', prop + '-1')]
+        for row, col in row_cols:
+            props[row], props[col] = props[col], props[row]
+
+    if top == 'right':
+        # and flip the new rows, which rotates particles by 90 degrees
+        if 'bbox-0' in props:
+            props['bbox-0'], props['bbox-2'] = width - props['bbox-2'], width - props['bbox-0']
+        for prop in ['centroid', 'weighted_centroid', 'centroid_weighted']:
+            if prop + '-0' in props:
+                props[prop + '-0'] = width - 1 - props[prop + '-0']
+    else:
+        # which mirrors particles along the diagonal
+        # NB: the last Hu moment changes sign with a mirror image
+        for prop in ['moments_hu', 'weighted_moments_hu', 'moments_weighted_hu']:
+            if prop + '-6' in props:
+                props[prop + '-6'] = -props[prop + '-6']
+
+    # recompute the orientation from the inertia tensor of the oriented
+    # particle, the angle itself is ambiguous for symmetric particles
+    if 'orientation' in props:
+        props['orientation'] = np.array([_orientation(r.inertia_tensor, top) for r in regions])
+
+    return(props)
+
+def _orientation(inertia_tensor, top):
+    # NB: this is skimage's RegionProperties.orientation
+    a, b, b, c = inertia_tensor.flat
+    # rows and columns are swapped
+    a, c = c, a
+    # and the new rows are flipped
+    if top == 'right':
+        b = -b
+    if a - c == 0:
+        if b < 0:
+            return(np.pi / 4.)
+        else:
+            return(-np.pi / 4.)
+    else:
+        return(0.5 * np.arctan2(-2 * b, c - a))
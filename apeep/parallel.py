@@ -0,0 +1,192 @@
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+
+import numpy as np
+
+import apeep.timers as t
+from apeep.buffers import buffer_pool
+from apeep.process import process_image
+from apeep.semantic import create_predictor
+
+# from ipdb import set_trace as db
+
+# Images are flat-fielded by the main process, in a ring of image buffers in
+# shared memory, and processed (enhanced, segmented, measured) by a pool of
+# worker processes, which access these buffers without copying them. A buffer
+# is reused only once the image it contains has been processed, and results
+# are collected in the order of the images.
+
+def start_workers(n, shape, dtype, cfg, environ, n_slots=None):
+    """
+    Start worker processes to process images in parallel
+
+    Args:
+        n (int): number of worker processes.
+        shape (tuple): shape of the images.
+        dtype: type of the images.
+        cfg (dict): configuration options.
+        environ (dataframe): environmental data, from `read_environ()`.
+        n_slots (int): number of image buffers in shared memory, i.e. of
+            images being processed simultaneously; by default, two more than
+            the number of workers, so that the next images can be flat-fielded
+            while all workers are busy.
+
+    Returns:
+        dict: state of the workers, to be passed to the other functions.
+    """
+    if n_slots is None:
+        n_slots = n + 2
+    shape = (n_slots,) + tuple(shape)
+
+    # allocate image buffers in shared memory
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    slots = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    # start workers, which attach to these buffers
+    pool = multiprocessing.Pool(n, initializer=_init_worker,
+        initargs=(shm.name, shape, dtype, cfg, environ))
+
+    workers = {
+        'pool': pool,
+        'shm': shm,
+        'slots': slots,
+        # index of the next slot to use
+        'next': 0,
+        # images being processed, in order
+        'pending': deque()
+    }
+    return(workers)
+
+def free_slot(workers):
+    """
+    Get the next image buffer, once it is free
+
+    Args:
+        workers (dict): state of the workers, from `start_workers()`.
+
+    Returns:
+        ndarray: image buffer, in which to write the next image to process.
+        list: results of the images processed so far, in order, as returned
+            by `collect()`; the processing of the image which used the buffer
+            is waited for.
+    """
+    results = []
+    # wait for the image in this slot, and therefore the ones before it
+    while workers['next'] in [p['slot'] for p in workers['pending']]:
+        results.append(_collect(workers['pending'].popleft()))
+    # and collect the following ones which are already done
+    results += collect(workers, wait=False)
+    return(workers['slots'][workers['next']], results)
+
+def submit(workers, image_info, stats=None):
+    """
+    Process the image in the current buffer in a worker
+
+    Args:
+        workers (dict): state of the workers, from `start_workers()`.
+        image_info (dict): information about the image, as passed to
+            `process_image()`.
+        stats (dict): statistics of grey levels of the image, as passed to
+            `process_image()`.
+
+    Returns:
+        Nothing
+    """
+    slot = workers['next']
+    result = workers['pool'].apply_async(_process_slot, (slot, image_info, stats))
+    workers['pending'].append({'slot': slot, 'result': result})
+    workers['next'] = (slot + 1) % workers['slots'].shape[0]
+    pass
+
+def collect(workers, wait=True):
+    """
+    Collect the results of processed images, in order
+
+    Args:
+        workers (dict): state of the workers, from `start_workers()`.
+        wait (bool): whether to wait for all images to be processed or only
+            collect the ones which are done (and come before any pending one).
+
+    Returns:
+        list: of (image_info, particles_props) tuples, where `image_info` is
+            the dict submitted for the image, as updated by `process_image()`,
+            and `particles_props` is its result.
+    """
+    results = []
+    while len(workers['pending']) > 0 and (wait or workers['pending'][0]['result'].ready()):
+        results.append(_collect(workers['pending'].popleft()))
+    return(results)
+
+def stop_workers(workers, wait=True):
+    """
+    Wait for all images to be processed and stop the workers
+
+    The worker processes are stopped and the shared memory is released in all
+    cases, even when processing an image failed.
+
+    Args:
+        workers (dict): state of the workers, from `start_workers()`.
+        wait (bool): whether to wait for the pending images to be processed or
+            to stop the workers at once, e.g. after an error.
+
+    Returns:
+        list: results of the remaining images, as returned by `collect()`.
+    """
+    results = []
+    try:
+        if wait:
+            results = collect(workers, wait=True)
+            workers['pool'].close()
+        else:
+            workers['pool'].terminate()
+    except BaseException:
+        workers['pool'].terminate()
+        raise
+    finally:
+        workers['pool'].join()
+        # release shared memory
+        # NB: remove it from the system first, which does not fail even when
+        #     arrays still point to it
+        del workers['slots']
+        workers['shm'].unlink()
+        workers['shm'].close()
+    return(results)
+
+def _collect(pending):
+    # NB: errors in the worker are raised here
+    return(pending['result'].get())
+
+# state of each worker process
+_worker = {}
+
+def _init_worker(shm_name, shape, dtype, cfg, environ):
+    log = logging.getLogger()
+    log.debug('start worker')
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # NB: keep a reference to the shared memory, which must stay open
+    _worker['shm'] = shm
+    _worker['slots'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker['cfg'] = cfg
+    _worker['environ'] = environ
+    _worker['pool'] = buffer_pool()
+    # load the semantic segmentation model in each worker
+    _worker['predictor'] = None
+    if cfg['segment']['pipeline'] != 'regular':
+        _worker['predictor'] = create_predictor(
+            model_weights=cfg['segment']['sem_model_path'],
+            config_file=cfg['segment']['sem_model_config'],
+            threshold=cfg['segment']['sem_conf_threshold']
+        )
+    pass
+
+def _process_slot(slot, image_info, stats):
+    start = t.b()
+    particles_props = process_image(_worker['slots'][slot], image_info,
+        _worker['cfg'], _worker['environ'], predictor=_worker['predictor'],
+        pool=_worker['pool'], stats=stats)
+    t.el(start, 'process ' + image_info['img_name'])
+    # NB: return the updated image_info too
+    return((image_info, particles_props))
@@ -0,0 +1,62 @@
+import numpy as np
+
+# from ipdb import set_trace as db
+
+# types in which images can be stored along the pipeline
+# NB: grey levels are floats in [0,1] or integers in [0,255]
+pixel_dtypes = ('float64', 'float32', 'uint8')
+
+def compute_dtype(dtype):
+    """
+    Get the type of floats used for computations on images of a given type
+
+    Args:
+        dtype: type of the images, one of `pixel_dtypes`.
+
+    Returns:
+        type: float64 for images of float64, float32 otherwise.
+    """
+    if np.dtype(dtype) == np.float64:
+        return(np.float64)
+    else:
+        return(np.float32)
+
+def to_float(x, out=None):
+    """
+    Convert grey levels to floats in [0,1]
+
+    Args:
+        x (ndarray): image of floats in [0,1] or of uint8 in [0,255].
+        out (ndarray): array of floats in which to store the result; when None,
+            images of floats are returned as is.
+
+    Returns:
+        ndarray: image of floats in [0,1].
+    """
+    if x.dtype == np.uint8:
+        dtype = np.float32 if out is None else out.dtype
+        x = np.divide(x, 255., out=out, dtype=dtype)
+    elif out is not None:
+        np.copyto(out, x)
+        x = out
+    return(x)
+
+def from_float(x, out):
+    """
+    Store grey levels in [0,1] into an image of a given type
+
+    Args:
+        x (ndarray): image of floats in [0,1]; modified in place when `out` is
+            of type uint8.
+        out (ndarray): image of floats or of uint8 in which to store `x`;
+            values outside of [0,1] are clipped in the second case.
+
+    Returns:
+        ndarray: `out`.
+    """
+    if out.dtype == np.uint8:
+        np.clip(x, 0, 1, out=x)
+        x *= 255
+        np.rint(x, out=x)
+    np.copyto(out, x, casting='unsafe')
+    return(out)
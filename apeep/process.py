@@ -0,0 +1,278 @@
+import logging
+import os
+import tarfile
+import shutil
+
+import numpy as np
+
+#import apeep.im_pillow as im
+import apeep.im_opencv as im
+#import apeep.im_lycon as im
+from apeep import stack
+from apeep.buffers import buffer
+from apeep.enhance import enhance, enhance_limits, rescale_stats
+from apeep.environ import merge_environ
+from apeep.histogram import image_stats
+from apeep.measure import measure, write_particles, write_particles_props
+from apeep.orientation import orient
+from apeep.pixels import compute_dtype
+from apeep.segment import segment, segmentation_threshold, update_threshold
+from apeep.semantic import semantic_segment, merge_masks
+
+# from ipdb import set_trace as db
+
+def process_image(img, image_info, cfg, environ, predictor=None, pool=None, stats=None):
+    """
+    Enhance, segment and measure a flat-fielded image and write the results
+
+    Args:
+        img (ndarray): flat-fielded image (of floats in [0,1] or of uint8 in
+            [0,255]), in acquisition orientation; enhanced in place.
+        image_info (dict): dict containing the name of the image, the transect
+            name and the avi_file, frame_nb and line_nb at the beggining and
+            the end of image; the segmentation threshold is added to it,
+            unless it already contains one, from `stream_threshold()`.
+        cfg (dict): configuration options.
+        environ (dataframe): environmental data, from `read_environ()`.
+        predictor (detectron2.modeling.meta_arch.rcnn.GeneralizedRCNN):
+            Detectron2 model, for semantic segmentation.
+        pool (dict): pool of buffers, from `buffer_pool()`, from which to draw
+            intermediate images; when None, they are allocated.
+        stats (dict): statistics of grey levels of `img`, from `image_stats()`,
+            when they are already computed.
+
+    Returns:
+        dataframe: properties of the particles, which still need to be
+            written with `commit_image()`; None when there are none to write.
+    """
+    # get general logger
+    log = logging.getLogger()
+
+    project_dir = cfg['io']['project_dir']
+    output_name = image_info['img_name']
+    top = cfg['acq']['top']
+    output = img
+
+    if cfg['flat_field']['go']:
+        if cfg['flat_field']['write_image']:
+            # rescale in [0,1] to save the image
+            minv = output.min()
+            maxv = output.max()
+            output_0_1 = buffer(pool, 'float', output.shape, compute_dtype(output.dtype))
+            np.subtract(output, minv, out=output_0_1)
+            output_0_1 /= (maxv - minv)
+            # TODO check it more thouroughly but this normalisation creates very inhomogeneous grey levels in the result
+
+            flat_fielded_image_dir = os.path.join(project_dir, 'flat_fielded')
+            os.makedirs(flat_fielded_image_dir, exist_ok=True)
+            im.save(orient(output_0_1, top=top), os.path.join(flat_fielded_image_dir, output_name + '.png'))
+
+    # compute the statistics of grey levels once, for all following steps
+    if stats is None and cfg['enhance']['percentiles'] == 'histogram':
+        stats = image_stats(output)
+
+    # enhance output image
+    if cfg['enhance']['go']:
+        # NB: in place, the flat-fielded image is not used afterwards
+        output = enhance(output, cfg, out=output, pool=pool, stats=stats)
+
+        if cfg['enhance']['write_image']:
+            enhanced_image_dir = os.path.join(project_dir, 'enhanced')
+            os.makedirs(enhanced_image_dir, exist_ok=True)
+            im.save(orient(output, top=top), os.path.join(enhanced_image_dir, output_name + '.png'))
+
+    # segment
+    if cfg['segment']['go']:
+        if 'gray_threshold' in image_info:
+            # use the threshold smoothed over previous images
+            gray_threshold = image_info['gray_threshold']
+        else:
+            # compute gray segmentation threshold
+            gray_threshold = segmentation_threshold(
+                output,
+                method=cfg['segment']['method'],
+                threshold=cfg['segment']['threshold'],
+                pool=pool,
+                stats=stats
+            )
+
+            # store gray segmentation threshold
+            image_info.update({
+                'gray_threshold': gray_threshold,
+            })
+
+        if cfg['segment']['pipeline'] == 'semantic':
+            # run semantic segmentation
+            output_labels, labels_stats = semantic_segment(
+                output,
+                gray_threshold=gray_threshold,
+                predictor=predictor,
+                sem_upsample_size=cfg['segment']['sem_upsample_size'],
+                sem_n_batches=cfg['segment']['sem_n_batches'],
+                dilate=cfg['segment']['dilate'],
+                erode=cfg['segment']['erode'],
+                sem_min_area=cfg['segment']['sem_min_area'],
+                sem_max_area=cfg['segment']['sem_max_area'],
+                top=top,
+                engine=cfg['segment']['labelling'],
+                return_stats=True
+            )
+
+        elif cfg['segment']['pipeline'] == 'regular':
+            # run regular segmentaion
+            output_labels, labels_stats = segment(
+                output,
+                gray_threshold=gray_threshold,
+                dilate=cfg['segment']['dilate'],
+                erode=cfg['segment']['erode'],
+                min_area=cfg['segment']['reg_min_area'],
+                max_area=cfg['segment']['reg_max_area'],
+                out=buffer(pool, 'labels', output.shape, np.int32),
+                pool=pool,
+                engine=cfg['segment']['labelling'],
+                return_stats=True,
+                threads=cfg['segment']['threads']
+            )
+
+        elif cfg['segment']['pipeline'] == 'both':
+            # run semantic segmentation
+            output_sem = semantic_segment(
+                output,
+                gray_threshold=gray_threshold,
+                predictor=predictor,
+                sem_upsample_size=cfg['segment']['sem_upsample_size'],
+                sem_n_batches=cfg['segment']['sem_n_batches'],
+                dilate=cfg['segment']['dilate'],
+                erode=cfg['segment']['erode'],
+                sem_min_area=cfg['segment']['sem_min_area'],
+                sem_max_area=cfg['segment']['sem_max_area'],
+                top=top,
+                engine=cfg['segment']['labelling']
+            )
+
+            # run regular segmentaion
+            output_reg = segment(
+                output,
+                gray_threshold=gray_threshold,
+                dilate=cfg['segment']['dilate'],
+                erode=cfg['segment']['erode'],
+                min_area=cfg['segment']['reg_min_area'],
+                max_area=cfg['segment']['reg_max_area'],
+                out=buffer(pool, 'segment_labels', output.shape, np.int32),
+                pool=pool,
+                engine=cfg['segment']['labelling'],
+                threads=cfg['segment']['threads']
+            )
+
+            # merge masks
+            output_labels, labels_stats = merge_masks(
+                semantic_mask=output_sem,
+                regular_mask=output_reg,
+                engine=cfg['segment']['labelling'],
+                out=buffer(pool, 'labels', output.shape, np.int32),
+                return_stats=True
+            )
+
+        if cfg['segment']['write_image']:
+            segmented_image_dir = os.path.join(project_dir, 'segmented')
+            os.makedirs(segmented_image_dir, exist_ok=True)
+            im.save(orient(output_labels == 0, top=top), os.path.join(segmented_image_dir, output_name + '.png'))
+
+        if cfg['segment']['write_stack']:
+            stack_image_dir = os.path.join(project_dir, 'stacked')
+            os.makedirs(stack_image_dir, exist_ok=True)
+            stack.save_stack(img=output, labels=output_labels, \
+                dest=os.path.join(stack_image_dir, output_name), format=cfg['segment']['stack_format'], \
+                top=top)
+
+    # measure
+    particles_props = None
+    if cfg['measure']['go'] and len(labels_stats['area']) > 0:
+        particles, particles_props = measure(
+            img=output,
+            img_labelled=output_labels,
+            image_info=image_info,
+            props=cfg['measure']['properties'],
+            top=top,
+            pool=pool,
+            stats=labels_stats
+        )
+
+        if cfg['measure']['write_particles']:
+            particles_images_dir = os.path.join(project_dir, 'particles', output_name)
+            # NB: start from an empty directory, in case the image was partly
+            #     written by an interrupted run
+            shutil.rmtree(particles_images_dir, ignore_errors=True)
+            os.makedirs(particles_images_dir)
+
+            # merge particles and environment data
+            particles_props = merge_environ(environ, particles_props, output_name)
+
+            # write particles images
+            # NB: the width of the image is the height of the viewing window
+            write_particles(particles, particles_images_dir, px2mm=cfg['acq']['window_height_mm']/output.shape[1])
+        else:
+            particles_props = None
+
+    return(particles_props)
+
+def stream_threshold(threshold_state, stats, cfg):
+    """
+    Compute the segmentation threshold of an image, smoothed over the previous ones
+
+    This is done in the order of the images, before they are processed, from
+    the statistics of their grey levels, transformed as `enhance()` transforms
+    grey levels.
+
+    Args:
+        threshold_state (dict): state of the threshold, from
+            `init_threshold()`; updated in place.
+        stats (dict): statistics of grey levels of the flat-fielded image, from
+            `image_stats()`.
+        cfg (dict): configuration options.
+
+    Returns:
+        float: gray segmentation threshold, in [0,1], to store in the
+            `image_info` passed to `process_image()`.
+    """
+    if cfg['enhance']['go']:
+        stats = rescale_stats(stats, *enhance_limits(stats, cfg))
+    gray_threshold = update_threshold(
+        threshold_state,
+        stats['band'],
+        method=cfg['segment']['method'],
+        threshold=cfg['segment']['threshold']
+    )
+    return(gray_threshold)
+
+def commit_image(particles_props, image_info, cfg):
+    """
+    Write the properties of the particles of an image
+
+    This is the last step of the processing of an image; it is done in the
+    order of the images.
+
+    Args:
+        particles_props (dataframe): properties of the particles, from
+            `process_image()`; when None, nothing is written.
+        image_info (dict): dict containing the name of the image.
+        cfg (dict): configuration options.
+
+    Returns:
+        Nothing
+    """
+    if particles_props is None:
+        return
+
+    particles_images_dir = os.path.join(cfg['io']['project_dir'], 'particles', image_info['img_name'])
+    write_particles_props(particles_props, particles_images_dir)
+
+    if cfg['measure']['as_tar']:
+        # Create a tar archive containing particles and properties
+        with tarfile.open(particles_images_dir + '.tar', 'w') as tar:
+            tar.add(particles_images_dir, arcname=os.path.basename(particles_images_dir))
+            tar.close()
+
+        # Delete directory
+        shutil.rmtree(particles_images_dir)
+    pass
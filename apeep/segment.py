@@ -1,23 +1,31 @@
+import concurrent.futures
+import functools
 import logging
 
+import cv2
 import numpy as np
+import scipy.ndimage
 import skimage.transform
 import skimage.morphology
 import skimage.measure
 import skimage.filters
 
 import apeep.timers as t
+from apeep.buffers import buffer
+from apeep.histogram import n_bins, otsu, percentile, rebin
+from apeep.pixels import to_float
 
 #from ipdb import set_trace as db
 
 @t.timer
-def segment(img, gray_threshold, dilate=3, erode=3,  min_area=150, max_area=400000):
+def segment(img, gray_threshold, dilate=3, erode=3,  min_area=150, max_area=400000, out=None, pool=None, engine='opencv', return_stats=False, threads=1):
     """
     Segment an image into particles
     
     Args:
-        img (ndarray): image (of type float)
-        gray_threshold (float): gray level threshold bellow which to consider particles
+        img (ndarray): image (of floats in [0,1] or of uint8 in [0,255])
+        gray_threshold (float): gray level threshold bellow which to consider particles,
+            in [0,1]
         dilate (int): after thresholding, particles are 'grown' by 'dilate' 
             pixels to include surrounding pixels which may be part of the object 
             but are not dark enough. NB: if Otsu's tresholding is used, `dilate` 
@@ -30,22 +38,47 @@ def segment(img, gray_threshold, dilate=3, erode=3,  min_area=150, max_area=4000
             `4/3*min_area`.
         max_area (int): maximum number of pixels in a particle to consider it.
             NB: this avoids the time-consuming segmentation of non relevant very large particles (streaks).
+        out (ndarray): array of int32 of the shape of `img` in which to store
+            the result; when None, a new one is allocated.
+        pool (dict): pool of buffers, from `buffer_pool()`, from which to draw
+            the intermediate images; when None, they are allocated.
+        engine (str): library which labels particles, see `label_particles()`.
+        return_stats (bool): whether to also return the statistics of the
+            particles.
+        threads (int): number of threads; when > 1, the image is split in
+            bands of rows, segmented in parallel, and particles which cross
+            the limits of bands are merged, which gives the same particles.
     
     Returns:
-        ndarray: masked image (mask with each particle larger than `min_area` and smaller than
-            `max_area` numbered as 1 and background as 0)
+        ndarray: labelled image (of int32, with each particle larger than
+            `min_area` and smaller than `max_area` numbered consecutively from
+            1 and background as 0)
+        dict: when `return_stats` is True, the statistics of these particles,
+            as returned by `label_particles()`, which `measure()` uses instead
+            of searching for them in the image.
     """
 
+    if img.dtype == np.uint8:
+        gray_threshold = gray_threshold * 255
+    if out is None:
+        out = np.empty(img.shape, dtype=np.int32)
+    
+    if threads > 1:
+        img_labelled_large, stats = _segment_bands(img, gray_threshold, dilate, erode,
+            min_area, max_area, out, pool, engine, threads)
+        if return_stats:
+            return(img_labelled_large, stats)
+        return(img_labelled_large)
+    
     # threshold image
-    img_binary = img < gray_threshold
+    img_binary = np.less(img, gray_threshold, out=buffer(pool, 'segment_binary', img.shape, bool))
     # pixels darker than threshold are True, others are False
         
     # perform morphological closing to fill gaps in particules
-    img_binary = skimage.morphology.binary_dilation(img_binary, skimage.morphology.disk(dilate))
-    img_binary = skimage.morphology.binary_erosion(img_binary, skimage.morphology.disk(erode))
+    img_binary = binary_closing(img_binary, dilate, erode)
         
     # label (i.e. find connected components of) particles and number them
-    img_labelled = skimage.measure.label(img_binary, background=False, connectivity=2)
+    img_labelled, stats = label_particles(img_binary, engine=engine, out=out)
     
     # keep only large particles
     
@@ -56,28 +89,261 @@ def segment(img, gray_threshold, dilate=3, erode=3,  min_area=150, max_area=4000
     # for r in small_regions:
     #     img_labelled_large[r._slice] = img_labelled_large[r._slice] * (img_labelled_large[r._slice] != r.label)
 
-    # recreate a labelled image with only large regions
-    regions = skimage.measure.regionprops(img_labelled)
-    large_regions = [r for r in regions if max_area >= fast_particle_area(r) > min_area]
-    img_masked_large = np.zeros_like(img_labelled)
+    # recreate a labelled image with only large regions, numbered consecutively
+    # NB: look up the new label of the region of each pixel, in place
+    relabel_lut, stats = _keep_particles(stats, min_area, max_area)
+    img_labelled_large = _relabel(relabel_lut, img_labelled)
     
-    for i in range(len(large_regions)):
-        r = large_regions[i]
-        img_masked_large[r._slice] = img_masked_large[r._slice] + r.image
+    if return_stats:
+        return(img_labelled_large, stats)
     
-    return(img_masked_large)
+    return(img_labelled_large)
+
+def _keep_particles(stats, min_area, max_area):
+    """
+    Select particles by area
+
+    Returns:
+        ndarray: new label of each particle (and of the background, first),
+            numbered consecutively, or 0 when it is not kept.
+        dict: statistics of the particles kept.
+    """
+    keep = (stats['area'] > min_area) & (stats['area'] <= max_area)
+    # the background, and the regions which are not kept, become 0
+    relabel_lut = np.zeros(len(keep) + 1, dtype=np.int32)
+    relabel_lut[1:][keep] = np.arange(1, np.sum(keep) + 1)
+    return(relabel_lut, {k: v[keep] for k, v in stats.items()})
+
+def _relabel(relabel_lut, img_labelled):
+    """
+    Look up the new label of each pixel of a labelled image, in place
+
+    Returns:
+        ndarray: `img_labelled`.
+    """
+    # NB: np.take() converts labels to indices (intp) first, so work by
+    #     chunks of lines, to avoid a copy of the whole image
+    chunk_size = max(1, 2**18 // max(1, img_labelled.shape[1]))
+    for i in range(0, img_labelled.shape[0], chunk_size):
+        chunk = img_labelled[i:i+chunk_size]
+        np.take(relabel_lut, chunk, out=chunk)
+    return(img_labelled)
+
+def _segment_bands(img, gray_threshold, dilate, erode, min_area, max_area, out, pool, engine, threads):
+    """
+    Segment an image by bands of rows, in parallel
+
+    Each band is thresholded and closed with `halo` rows on each side, which
+    are all the pixels the closing of the band depends on, and its own rows
+    are labelled. Particles which touch across the limit between two bands are
+    then merged, with a union-find over the pairs of labels which touch.
+
+    Returns:
+        ndarray: `out`, the labelled image, as returned by `segment()`.
+        dict: statistics of the particles.
+    """
+    n_rows, n_cols = img.shape
+    n_bands = min(threads, n_rows)
+    limits = [(n_rows * i) // n_bands for i in range(n_bands + 1)]
+    halo = dilate + erode
+
+    def label_band(i):
+        first, last = limits[i], limits[i+1]
+        start = max(first - halo, 0)
+        stop = min(last + halo, n_rows)
+        band_binary = np.less(img[start:stop], gray_threshold,
+            out=buffer(pool, 'segment_binary_' + str(i), (stop - start, n_cols), bool))
+        # NB: the closing considers the limits of the halo as those of the
+        #     image, which only changes the result within the halo
+        band_binary = binary_closing(band_binary, dilate, erode)
+        return(label_particles(band_binary[first-start:last-start], engine=engine, out=out[first:last])[1])
+
+    with concurrent.futures.ThreadPoolExecutor(n_bands) as executor:
+        bands_stats = list(executor.map(label_band, range(n_bands)))
+
+        # number the particles of all bands after each other
+        n = np.array([len(s['area']) for s in bands_stats])
+        offsets = np.concatenate([[0], np.cumsum(n)])
+        stats = {k: np.concatenate([s[k] for s in bands_stats]) for k in bands_stats[0]}
+        # with positions in the image
+        rows_offset = np.repeat(limits[:-1], n)
+        stats['bbox'] = stats['bbox'] + np.stack([rows_offset, 0 * rows_offset, rows_offset, 0 * rows_offset], axis=1)
+        stats['centroid'] = stats['centroid'] + np.stack([rows_offset, 0 * rows_offset], axis=1)
+
+        # find the particles which touch across the limits of bands
+        # NB: 8-connectivity, pixels touch their neighbours in diagonal too
+        parent = np.arange(offsets[-1] + 1)
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return(x)
+        for i in range(1, n_bands):
+            above = out[limits[i] - 1]
+            below = out[limits[i]]
+            for shift in (-1, 0, 1):
+                a = above[max(0, -shift):n_cols - max(0, shift)]
+                b = below[max(0, shift):n_cols - max(0, -shift)]
+                touching = (a > 0) & (b > 0)
+                pairs = np.unique(np.stack([a[touching] + offsets[i-1], b[touching] + offsets[i]], axis=1), axis=0)
+                for x, y in pairs:
+                    # merge them in the particle which comes first
+                    x, y = find(x), find(y)
+                    parent[max(x, y)] = min(x, y)
+        # point all merged particles to the first one
+        merged = np.flatnonzero(parent != np.arange(len(parent)))
+        parent[merged] = [find(x) for x in merged]
+
+        # compute the statistics of merged particles
+        is_root = parent[1:] == np.arange(1, len(parent))
+        particle = (np.cumsum(is_root) - 1)[parent[1:] - 1]
+        n_particles = np.sum(is_root)
+        area = np.bincount(particle, weights=stats['area'], minlength=n_particles)
+        bbox = np.empty((n_particles, 4), dtype=stats['bbox'].dtype)
+        bbox[:,0:2] = np.iinfo(bbox.dtype).max
+        bbox[:,2:4] = np.iinfo(bbox.dtype).min
+        for j, ufunc in enumerate([np.minimum, np.minimum, np.maximum, np.maximum]):
+            ufunc.at(bbox[:,j], particle, stats['bbox'][:,j])
+        centroid = np.stack([np.bincount(particle, weights=stats['centroid'][:,j] * stats['area'], minlength=n_particles) for j in range(2)], axis=1) / area[:,np.newaxis]
+        stats = {'area': area.astype(stats['area'].dtype), 'bbox': bbox, 'centroid': centroid}
+
+        # keep only large particles
+        relabel_lut, stats = _keep_particles(stats, min_area, max_area)
+        # and look up the new label of each particle of each band
+        relabel_lut = relabel_lut[np.concatenate([[0], particle + 1])]
+
+        def relabel_band(i):
+            first, last = limits[i], limits[i+1]
+            band_lut = np.concatenate([relabel_lut[:1], relabel_lut[offsets[i]+1:offsets[i+1]+1]])
+            _relabel(band_lut, out[first:last])
+        list(executor.map(relabel_band, range(n_bands)))
+
+    return(out, stats)
 
  
+def label_particles(img_binary, engine='opencv', out=None):
+    """
+    Label the connected components of a binary image, with their statistics
+
+    Components are 8-connected, as with
+    `skimage.measure.label(connectivity=2)`.
+
+    Args:
+        img_binary (ndarray): binary image (of bool, or of integers, where
+            non-zero pixels are particles).
+        engine (str): library which labels particles, 'opencv' (with
+            `cv2.connectedComponentsWithStats()`, which computes the statistics
+            while labelling) or 'scipy' (with `scipy.ndimage.label()`).
+        out (ndarray): array of int32 of the shape of `img_binary` in which to
+            store the labels; when None, a new one is allocated.
+
+    Returns:
+        ndarray: labelled image, with particles numbered from 1 and the
+            background as 0.
+        dict: statistics of the particles, in the order of their labels,
+            containing
+            area (ndarray): number of pixels.
+            bbox (ndarray): min_row, min_col, max_row, max_col of their
+                bounding box, as in `skimage.measure.regionprops()`.
+            centroid (ndarray): row, col of their centroid.
+    """
+    if img_binary.dtype == bool:
+        img_binary = img_binary.view(np.uint8)
+    elif img_binary.dtype != np.uint8:
+        img_binary = (img_binary != 0).view(np.uint8)
+    if out is None:
+        out = np.empty(img_binary.shape, dtype=np.int32)
+
+    if engine == 'opencv':
+        n, labels, cc_stats, centroids = cv2.connectedComponentsWithStats(img_binary,
+            labels=out, connectivity=8, ltype=cv2.CV_32S)
+        # NB: the first component is the background
+        x = cc_stats[1:,cv2.CC_STAT_LEFT]
+        y = cc_stats[1:,cv2.CC_STAT_TOP]
+        stats = {
+            'area': cc_stats[1:,cv2.CC_STAT_AREA],
+            'bbox': np.stack([y, x, y + cc_stats[1:,cv2.CC_STAT_HEIGHT], x + cc_stats[1:,cv2.CC_STAT_WIDTH]], axis=1),
+            'centroid': centroids[1:,::-1]
+        }
+    elif engine == 'scipy':
+        n = scipy.ndimage.label(img_binary, structure=np.ones((3,3)), output=out)
+        labels = out
+        slices = scipy.ndimage.find_objects(labels)
+        stats = {
+            'area': np.bincount(labels.ravel(), minlength=n + 1)[1:],
+            'bbox': np.array([(r.start, c.start, r.stop, c.stop) for r, c in slices], dtype=np.intp).reshape((n, 4)),
+            'centroid': np.array(scipy.ndimage.center_of_mass(img_binary, labels, np.arange(1, n + 1))).reshape((n, 2))
+        }
+    else:
+        raise ValueError('unknown `engine` argument')
+    return(labels, stats)
+
+def binary_closing(img_binary, dilate=3, erode=3):
+    """
+    Dilate then erode a binary image, in place
+
+    This gives the same result as `skimage.morphology.binary_dilation()`
+    followed by `skimage.morphology.binary_erosion()` with disks, but uses
+    OpenCV and only processes the parts of the image around True pixels,
+    which are usually a small fraction of it.
+
+    Args:
+        img_binary (ndarray): binary image (of bool); modified in place.
+        dilate (int): radius of the disk by which to dilate.
+        erode (int): radius of the disk by which to erode.
+
+    Returns:
+        ndarray: `img_binary`.
+    """
+    # the result is False further than `dilate` from a True pixel, and erosion
+    # then reads `erode` pixels around it, so only the pixels within `margin`
+    # of True pixels are needed
+    margin = dilate + erode
+    n_rows, n_cols = img_binary.shape
+
+    # find the bands of rows around True pixels, separated by more than
+    # 2 * margin rows
+    rows = np.flatnonzero(np.any(img_binary, axis=1))
+    if len(rows) == 0:
+        return(img_binary)
+    gaps = np.flatnonzero(np.diff(rows) > 2 * margin)
+    firsts = np.concatenate([rows[:1], rows[gaps + 1]])
+    lasts = np.concatenate([rows[gaps], rows[-1:]])
+
+    dilate_kernel = _disk(dilate)
+    erode_kernel = _disk(erode)
+    for first, last in zip(firsts, lasts):
+        # restrict each band to the columns around True pixels
+        r0 = max(first - margin, 0)
+        r1 = min(last + margin + 1, n_rows)
+        cols = np.flatnonzero(np.any(img_binary[first:last+1,:], axis=0))
+        c0 = max(cols[0] - margin, 0)
+        c1 = min(cols[-1] + margin + 1, n_cols)
+        # NB: OpenCV considers pixels outside of the window as False when
+        #     dilating and True when eroding, as skimage does outside of the
+        #     image; within the image, the pixels outside the window are False
+        #     once dilated, but they are never reached by the erosion of a
+        #     True pixel
+        window = img_binary[r0:r1,c0:c1].view(np.uint8)
+        window[:] = cv2.erode(cv2.dilate(window, dilate_kernel), erode_kernel)
+    return(img_binary)
+
+@functools.lru_cache()
+def _disk(radius):
+    # structuring element, as a kernel for OpenCV
+    return(skimage.morphology.disk(radius).astype(np.uint8))
+
 def fast_particle_area(x):
     return(np.sum(x._label_image[x._slice] == x.label))
 
 
-def segmentation_threshold(img, method='auto', threshold=0.5, var_limit=0.0015):
+def segmentation_threshold(img, method='auto', threshold=0.5, var_limit=0.0015, pool=None, stats=None):
     """
     Compute image gray level segmentation threshold according to chosen method. 
     
     Args:
-        img (ndarray): image (of type float)
+        img (ndarray): image (of floats in [0,1] or of uint8 in [0,255]), in
+            acquisition orientation (one scanned line per row)
         method (str): string defining the method for thresholding.
             - 'static' considers `threshold` as a grey value in [0,100].
             - 'percentile' considers `threshold` as a percentile of grey levels,
@@ -90,9 +356,14 @@ def segmentation_threshold(img, method='auto', threshold=0.5, var_limit=0.0015):
             threshold will be considered as part of particles.
         var_limit (flt): value of the variance in the grey levels of the central
             part of `img` under which Ostu tresholding is used.
+        pool (dict): pool of buffers, from `buffer_pool()`, from which to draw
+            intermediate images; when None, they are allocated.
+        stats (dict): statistics of grey levels of `img`, from `image_stats()`;
+            when given, the threshold is computed from the histogram of its
+            central band, without reading `img`.
     
     Returns:
-        float: gray segmentation threshold for given image
+        float: gray segmentation threshold for given image, in [0,1]
     """
     # get general logger
     log = logging.getLogger()
@@ -100,13 +371,21 @@ def segmentation_threshold(img, method='auto', threshold=0.5, var_limit=0.0015):
     if method == 'static':
         # convert value to be within [0,1]
         gray_threshold = threshold / 100.
+    elif stats is not None:
+        gray_threshold = _threshold_from_histogram(stats['band'], method, threshold)
     else:
         # Small image to compute thresholds if not generated by enhance        
         # crop and rescale image to compute the distribution of grey levels on 
         # the center of the image and an on a smaller one, which is both more
         # precise and faster
-        crop = img.shape[0]//4
-        img_c = img[crop:3*crop,:] # central band = more noise, fewer artifacts
+        crop = img.shape[1]//4
+        img_c = img[:,crop:3*crop] # central band = more noise, fewer artifacts
+        # NB: the image is in acquisition orientation, so the band is the
+        #     central part of the scanned lines
+        # NB: convert raw grey levels here, rather than let skimage convert
+        #     them to a new image of float64
+        if img_c.dtype == np.uint8:
+            img_c = to_float(img_c, out=buffer(pool, 'float', img.shape, np.float32)[:,crop:3*crop])
         img_c_small = skimage.transform.rescale(img_c, 0.2, multichannel=False, anti_aliasing=False)
 
         if method == 'percentile':
@@ -119,4 +398,77 @@ def segmentation_threshold(img, method='auto', threshold=0.5, var_limit=0.0015):
         else:
             raise ValueError('unknown `method` argument')
     
-    return gray_threshold
\ No newline at end of file
+    return gray_threshold
+
+def _threshold_from_histogram(hist, method, threshold):
+    if method == 'percentile':
+        gray_threshold = float(percentile(hist, threshold))
+    elif method == 'otsu':
+        gray_threshold = float(otsu(hist))
+    elif method == 'q1':
+        q1 = percentile(hist, 25)
+        gray_threshold = float(3.80 * q1 + threshold)
+    else:
+        raise ValueError('unknown `method` argument')
+    return(gray_threshold)
+
+def init_threshold(window):
+    """
+    Initialise a segmentation threshold smoothed over successive images
+
+    Args:
+        window (int): number of images over which the distribution of grey
+            levels is smoothed; each image weighs `1 - 1/window` times less than
+            the next one.
+
+    Returns:
+        dict: state of the threshold, to be passed to `update_threshold()`.
+    """
+    threshold_state = {
+        # running histogram of grey levels, on fixed bins
+        'hist': None,
+        'decay': 1 - 1 / window
+    }
+    return(threshold_state)
+
+def update_threshold(threshold_state, hist, method='auto', threshold=0.5):
+    """
+    Add the grey levels of an image to a smoothed segmentation threshold
+
+    The histogram of the image is added to a running histogram, in which the
+    previous ones decay, and the threshold is computed from it, as
+    `segmentation_threshold()` computes it from the histogram of a single
+    image. The cost does not depend on the size of images.
+
+    Args:
+        threshold_state (dict): state of the threshold, from
+            `init_threshold()`; updated in place.
+        hist (dict): histogram of the grey levels of the central band of the
+            image, from `image_stats()`.
+        method (str): method for thresholding, as in `segmentation_threshold()`.
+        threshold (flt): grey level or percentage, as in
+            `segmentation_threshold()`.
+
+    Returns:
+        float: gray segmentation threshold for this image, in [0,1]
+    """
+    if not hist['discrete']:
+        # count floats in fixed bins over [0,1], which do not depend on the image
+        hist = rebin(hist, np.linspace(0, 1, n_bins + 1))
+
+    running = threshold_state['hist']
+    if running is None:
+        running = {
+            'counts': hist['counts'].astype(np.float64),
+            'edges': hist['edges'],
+            'discrete': hist['discrete']
+        }
+    else:
+        running['counts'] *= threshold_state['decay']
+        running['counts'] += hist['counts']
+    threshold_state['hist'] = running
+
+    if method == 'static':
+        # convert value to be within [0,1]
+        return(threshold / 100.)
+    return(_threshold_from_histogram(running, method, threshold))
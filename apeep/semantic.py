@@ -14,18 +14,20 @@ from detectron2.checkpoint import DetectionCheckpointer
 import detectron2.data.transforms as T
 
 import apeep.timers as t
+from apeep.orientation import orient, unorient
 
 from .segment import *
 
 #from ipdb import set_trace as db
 
 @t.timer
-def semantic_segment(img, gray_threshold, predictor, sem_upsample_size, sem_n_batches=1, dilate=3, erode=2, sem_min_area=50, sem_max_area=300):
+def semantic_segment(img, gray_threshold, predictor, sem_upsample_size, sem_n_batches=1, dilate=3, erode=2, sem_min_area=50, sem_max_area=300, top='right', engine='opencv', return_stats=False):
     """
     Segment an image into particles using semantic segmentation
     
     Args:
-        img (ndarray): image (of type float) to segment
+        img (ndarray): image (of floats in [0,1] or of uint8 in [0,255]) to
+            segment, in acquisition orientation (one scanned line per row)
         gray_threshold (float): gray level threshold bellow which to consider particles
         predictor (detectron2.modeling.meta_arch.rcnn.GeneralizedRCNN): Detectron2 model to use for prediction
         sem_upsample_size (int): size of upsampled frames
@@ -39,16 +41,22 @@ def semantic_segment(img, gray_threshold, predictor, sem_upsample_size, sem_n_ba
             dilation + erosion fills gaps in particles. 
         sem_min_area (int): minimum size of particles generated by semantic segmentation
         sem_max_area (int): maximum size of particles generated by semantic segmentation
+        top (str): side of the scanned lines which is the top of the picture;
+            the model predicts particles on the image oriented with the top up
+        engine (str): library which labels particles, see `label_particles()`.
+        return_stats (bool): whether to also return the statistics of the
+            particles, as `segment()` does.
         
     Returns:
-        mask_lab (ndarray): labelled image (mask with each particle larger than `sem_min_area` and smaller 
+        mask_lab (ndarray): labelled image (of int32, with each particle larger than `sem_min_area` and smaller 
             than `sem_max_area` numbered as an integer)
+        dict: when `return_stats` is True, the statistics of these particles.
     """
     # get general logger
     log = logging.getLogger()
     
-    # generate frames
-    frames, frames_props = generate_frames(img, sem_upsample_size=sem_upsample_size)
+    # generate frames, from the image oriented with the top up
+    frames, frames_props = generate_frames(orient(img, top=top), sem_upsample_size=sem_upsample_size)
     
     # predict frames
     predictions = predict_frames(
@@ -60,10 +68,12 @@ def semantic_segment(img, gray_threshold, predictor, sem_upsample_size, sem_n_ba
     
     # generate new image with ROIs only
     img_rois = extract_rois(
-        img=img,
+        img=orient(img, top=top),
         preds=predictions,
         dilate=dilate
     )
+    # and put it back in acquisition orientation
+    img_rois = unorient(img_rois, top=top)
     
     # threshold image
     mask_lab = segment(
@@ -72,7 +82,9 @@ def semantic_segment(img, gray_threshold, predictor, sem_upsample_size, sem_n_ba
         dilate=dilate,
         erode=erode,
         min_area=sem_min_area,
-        max_area=sem_max_area
+        max_area=sem_max_area,
+        engine=engine,
+        return_stats=return_stats
     )
     
     return(mask_lab)
@@ -127,7 +139,7 @@ def generate_frames(img, nb_h_frames=5, nb_w_frames=26, frame_size=524, sem_upsa
         frames_props (dict): dict of frames label and coordinates
     """
     ## Convert large image to range [0, 255] and make it a 3 channels image
-    if img.max() <= 1:
+    if img.dtype != np.uint8 and img.max() <= 1:
         img = img*255    
     img = np.stack([img, img, img], axis=2)
     
@@ -276,7 +288,7 @@ def extract_rois(img, preds, dilate=2):
     Return a blank image with only background of ROIs.
 
     Args:
-        img (array): image 
+        img (array): image (of floats in [0,1] or of uint8 in [0,255])
         preds(df): predictions from Detectron2
         dilate (int): number of pixels to grow particles and bboxes with (dilation). 
 
@@ -286,40 +298,49 @@ def extract_rois(img, preds, dilate=2):
     # Get image dimensions
     h, w = img.shape
     
-    # Create a blank mask for predictions bbox 
-    img_blank = np.zeros_like(img)
+    # Create a white image to paste prediction bbox content
+    white = 255 if img.dtype == np.uint8 else 1
+    img_rois = np.full_like(img, white)
 
     for i in preds.index:
         # Extract bbox of each prediction 
         bbox = preds.loc[i, 'bbox_corr']
-        # Replace prediction bbox by 1 with `dilate` extra px on each side so particle can be dilated
+        # Paste bbox content with `dilate` extra px on each side so particle can be dilated
         # Make sure that slice do not cross images borders
-        img_blank[
-            max(0, bbox[1]-dilate):min(h, bbox[3]+dilate),
-            max(0, bbox[0]-dilate):min(w, bbox[2]+dilate)
-        ] = 1
-    
-    # Create a blank image to paste prediction bbox content
-    img_rois = np.ones_like(img)
-    # Paste bbox content into new image
-    img_rois = np.multiply(img_blank, img) + (np.ones_like(img) - img_blank)
+        roi = (
+            slice(max(0, bbox[1]-dilate), min(h, bbox[3]+dilate)),
+            slice(max(0, bbox[0]-dilate), min(w, bbox[2]+dilate))
+        )
+        img_rois[roi] = img[roi]
     
     return(img_rois)
 
 
-def merge_masks(semantic_mask, regular_mask):
+def merge_masks(semantic_mask, regular_mask, engine='opencv', out=None, return_stats=False):
     """
     Merge semantic and regular image masks and return a labelled mask. 
 
     Args:
-        semantic_mask (array): image mask generated by semantic segmentation
-        regular_mask (array): image mask generated by gray level segmentation
+        semantic_mask (array): labelled image generated by semantic segmentation
+        regular_mask (array): labelled image generated by gray level segmentation
+        engine (str): library which labels particles, see `label_particles()`.
+        out (ndarray): array of int32 of the shape of the masks in which to
+            store the result; when None, a new one is allocated.
+        return_stats (bool): whether to also return the statistics of the
+            particles, as `segment()` does.
 
     Returns:
-        ndarray: merged image mask (particles as 1 and background as 0)
+        ndarray: merged labelled image (of int32, particles numbered
+            consecutively from 1 and background as 0)
+        dict: when `return_stats` is True, the statistics of these particles.
     """
     
     ## Compute mask overlap
-    mask = np.logical_or(semantic_mask > 0, regular_mask > 0).astype(int);
+    mask = np.logical_or(semantic_mask > 0, regular_mask > 0)
+    # and label the particles of the merged mask, which overlapping particles
+    # of the two masks form
+    labels, stats = label_particles(mask, engine=engine, out=out)
 
-    return(mask)
\ No newline at end of file
+    if return_stats:
+        return(labels, stats)
+    return(labels)
\ No newline at end of file
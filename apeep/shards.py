@@ -0,0 +1,187 @@
+import copy
+import glob
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+import yaml
+
+# from ipdb import set_trace as db
+
+# A transect can be split in shards, which process contiguous ranges of its
+# images as independent jobs, on one or several machines. Each shard is a
+# project of its own, with the configuration of the transect, which runs
+# `apeep --start ... --end ...`: it reads the `window_size` lines before its
+# first image to compute the flat-field there (its warm-up overlap with the
+# previous shard) and images, their names and the subsampling of images are
+# defined from the start of the transect, so that shards produce the same
+# images as a single run, with two exceptions:
+# - with `flat_field > method: ema`, the moving average is started from the
+#   mean of these lines rather than from the whole transect before, so the
+#   first images of a shard differ slightly from those of a single run;
+# - the segmentation threshold smoothed over `segment > threshold_window`
+#   images restarts at the start of each shard.
+# Their outputs are then merged in the project.
+
+# directories of the outputs written for each image
+output_dirs = ['particles', 'flat_fielded', 'enhanced', 'segmented', 'stacked']
+
+def split_images(first, last, n):
+    """
+    Split a range of images in contiguous shards
+
+    Args:
+        first, last (int): indexes of the first and last images of the range.
+        n (int): number of shards.
+
+    Returns:
+        list: of (first, last) indexes of the images of each shard, which
+            contain the same number of images, give or take one.
+    """
+    n_images = last - first + 1
+    n = max(1, min(n, n_images))
+    bounds = [first + (n_images * i) // n for i in range(n + 1)]
+    return([(bounds[i], bounds[i+1] - 1) for i in range(n)])
+
+def create_shards(project_dir, cfg, first, last, n):
+    """
+    Split a project in shards and write a job to process each of them
+
+    The shards are projects in `shards/shard_*` in the project directory.
+    The job of each shard is a shell script next to it, which can be run
+    directly or submitted to a scheduler; it resumes the shard when it is
+    run again.
+
+    Args:
+        project_dir (str): path to the project directory.
+        cfg (dict): configuration of the project.
+        first, last (int): indexes of the first and last images to process,
+            starting from 0.
+        n (int): number of shards.
+
+    Returns:
+        list: of dicts, one per shard, containing
+            dir (str): path to the directory of the shard.
+            first, last (int): indexes of its first and last images.
+            job (str): path to its job script.
+    """
+    # get general logger
+    log = logging.getLogger()
+
+    shards_dir = os.path.abspath(os.path.join(project_dir, 'shards'))
+    os.makedirs(shards_dir, exist_ok=True)
+
+    # configuration of the shards
+    shard_cfg = copy.deepcopy(cfg)
+    del shard_cfg['io']['project_dir']
+    # NB: a frame cache would contain the whole transect in each shard
+    shard_cfg['io']['cache'] = False
+    # NB: paths relative to the project are made absolute
+    shard_cfg['io']['input_dir'] = os.path.abspath(cfg['io']['input_dir'])
+    if cfg['segment']['pipeline'] != 'regular':
+        for path in ['sem_model_path', 'sem_model_config']:
+            shard_cfg['segment'][path] = os.path.abspath(cfg['segment'][path])
+    profile = shard_cfg['flat_field']['profile']
+    if profile is not None and not os.path.isabs(profile):
+        shard_cfg['flat_field']['profile'] = os.path.abspath(os.path.join(project_dir, profile))
+
+    shards = []
+    for i, (first_img, last_img) in enumerate(split_images(first, last, n)):
+        name = 'shard_' + str(i + 1).zfill(len(str(n)))
+        shard_dir = os.path.join(shards_dir, name)
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(os.path.join(shard_dir, 'config.yaml'), 'w') as ymlfile:
+            yaml.safe_dump(shard_cfg, ymlfile, default_flow_style=False, sort_keys=False)
+        # reuse the index of the avi files of the project
+        index_file = os.path.join(project_dir, 'avi_index.tsv')
+        if os.path.exists(index_file):
+            shutil.copy(index_file, shard_dir)
+
+        # write the job
+        # NB: image numbers start at 1 on the command line
+        job = os.path.join(shards_dir, name + '.sh')
+        command = [sys.executable, '-m', 'apeep', '--resume',
+                   '--start', str(first_img + 1), '--end', str(last_img + 1), shard_dir]
+        with open(job, 'w') as f:
+            f.write('#!/bin/sh\n')
+            f.write('# process images ' + str(first_img + 1) + ' to ' + str(last_img + 1) + ' of ' + os.path.abspath(project_dir) + '\n')
+            f.write(' '.join(shlex.quote(c) for c in command) + '\n')
+        os.chmod(job, 0o755)
+
+        shards.append({'dir': shard_dir, 'first': first_img, 'last': last_img, 'job': job})
+        log.info(name + ': images ' + str(first_img + 1) + ' to ' + str(last_img + 1) + ', job in ' + job)
+
+    return(shards)
+
+def run_shards(shards):
+    """
+    Run the jobs of shards in local processes, simultaneously
+
+    Args:
+        shards (list): shards, from `create_shards()`.
+
+    Returns:
+        Nothing
+    """
+    # get general logger
+    log = logging.getLogger()
+
+    # NB: each shard logs in its own directory
+    jobs = [subprocess.Popen(['/bin/sh', s['job']], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for s in shards]
+    failed = []
+    for s, job in zip(shards, jobs):
+        if job.wait() == 0:
+            log.info(os.path.basename(s['dir']) + ' done')
+        else:
+            log.error(os.path.basename(s['dir']) + ' failed, see its log in ' + os.path.join(s['dir'], 'log'))
+            failed.append(s)
+    if len(failed) > 0:
+        raise RuntimeError(str(len(failed)) + ' shards failed; run their jobs again to resume them')
+    pass
+
+def merge_shards(project_dir):
+    """
+    Merge the outputs of the shards of a project in the project
+
+    The outputs of each image are moved from the shards to the project, where
+    they replace those of an image of the same name. Merging can therefore be
+    repeated, e.g. after resuming some shards.
+
+    Args:
+        project_dir (str): path to the project directory.
+
+    Returns:
+        int: number of images merged.
+    """
+    # get general logger
+    log = logging.getLogger()
+
+    shards = sorted(glob.glob(os.path.join(project_dir, 'shards', 'shard_*/')))
+    if len(shards) == 0:
+        raise RuntimeError('no shards in ' + os.path.join(project_dir, 'shards'))
+
+    n_images = 0
+    for shard_dir in shards:
+        images = set()
+        for output in output_dirs:
+            shard_output = os.path.join(shard_dir, output)
+            if not os.path.isdir(shard_output):
+                continue
+            project_output = os.path.join(project_dir, output)
+            os.makedirs(project_output, exist_ok=True)
+            for f in sorted(os.listdir(shard_output)):
+                dest = os.path.join(project_output, f)
+                if os.path.isdir(dest):
+                    shutil.rmtree(dest)
+                elif os.path.exists(dest):
+                    os.remove(dest)
+                shutil.move(os.path.join(shard_output, f), dest)
+                # NB: outputs are named after their image
+                images.add(f.split('.')[0])
+        log.info(str(len(images)) + ' images merged from ' + os.path.basename(os.path.normpath(shard_dir)))
+        n_images += len(images)
+
+    return(n_images)
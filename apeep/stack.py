@@ -6,16 +6,22 @@ from pytoshop.user import nested_layers
 import pytoshop.enums as pse
 
 import apeep.timers as t
+from apeep.pixels import to_float
 
 # from ipdb import set_trace as db
 
 @t.timer
-def save_stack(img, labels, dest, format=['rgb', 'tif', 'psd']):
-    # rotate images back to vertical (top will always be on the right)
+def save_stack(img, labels, dest, format=['rgb', 'tif', 'psd'], top='right'):
+    # NB: only the mask of particles is needed from the labelled image
+    particles = labels != 0
+    # keep images vertical, as acquired, with the top always on the right
     # (easier to deal with on tablet)
-    img = np.rot90(img, 1, (1,0)).copy(order='C')
-    labels = np.rot90(labels, 1, (1,0)).copy(order='C')
+    if top == 'left':
+        img = np.ascontiguousarray(img[:,::-1])
+        particles = np.ascontiguousarray(particles[:,::-1])
     # NB: pytoshop requires C-contiguous arrays
+    # convert raw grey levels to [0,1]
+    img = to_float(img)
     
     # get image size
     nrow, ncol = img.shape
@@ -23,8 +29,8 @@ def save_stack(img, labels, dest, format=['rgb', 'tif', 'psd']):
     # RGB image where the mask is red
     if 'rgb' in format:    
         masked = np.zeros((nrow, ncol, 3), dtype='uint8')
-        masked[:,:,0] = (img * 254 + 1) * (labels != 0)  # R
-        masked[:,:,1] = (img * 254 + 1) * (labels == 0)  # G
+        masked[:,:,0] = (img * 254 + 1) * particles   # R
+        masked[:,:,1] = (img * 254 + 1) * ~particles  # G
         masked[:,:,2] = masked[:,:,1]                  # B
         # NB: shift of 1 from the background to be able to easily re-extract the mask
         # save to file
@@ -41,7 +47,7 @@ def save_stack(img, labels, dest, format=['rgb', 'tif', 'psd']):
         back_img = Image.fromarray(back)
         # create mask as RGBA
         mask = np.zeros((nrow, ncol, 4), dtype='uint8')
-        mask[:,:,0] = (labels != 0) * 255
+        mask[:,:,0] = particles * 255
         mask[:,:,3] = mask[:,:,0]
         mask_img = Image.fromarray(mask)
         # save as multipage TIFF
@@ -58,7 +64,7 @@ def save_stack(img, labels, dest, format=['rgb', 'tif', 'psd']):
             2: back  # B
         }
         # create mask as RGBA
-        mask = ((labels != 0) * 255).astype(np.uint8)
+        mask = (particles * 255).astype(np.uint8)
         mask_dict = {
             0 : mask,  # R
             1 : blank, # G
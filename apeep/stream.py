@@ -1,35 +1,39 @@
 import glob
+import itertools
 import logging
 import os
 import datetime
+import queue
+import subprocess
+import threading
+import time
 
 import av
+import cv2
 import numpy as np
 import pandas as pd
 
 # from ipdb import set_trace as db
 
-def stream(dir, n=1):
+# hardcode frame dimensions
+frame_height = 2048
+frame_width  = 2048
+
+# pixel formats in which the first plane contains the 8-bit luminance
+luma_formats = ('gray', 'gray8', 'nv12', 'nv21',
+    'yuv410p', 'yuv411p', 'yuv420p', 'yuv422p', 'yuv440p', 'yuv444p',
+    'yuvj411p', 'yuvj420p', 'yuvj422p', 'yuvj440p', 'yuvj444p')
+
+def list_avi(dir):
     """
-    Get a stream of lines of pixels from a directory
-    
-    ISIIS scans lines, hence creating a continuous stream of lines of pixels. 
-    This stream is cut into 2048x2048 frames (lines are scanned from top to
-    bottom in each frame), which are stored in successive avi files.
-    This generator abstracts that storage, loops over avi files and their
-    frames to return blocks of `n` scanned lines at a time
+    List avi files in a directory
     
     Args:
         dir (str): path to input directory containing .avi files
-        n (int): number of lines of the stream to return at each iteration
     
-    Yields:
-         dict: containing
-            filename (str): name of the current avi file.
-            timecode (datetime): timecode for the start of the current avi file (deduced from its name).
-            frame_nb (int): number of the frame in the current avi file, starting from 0.
-            line_nb (int): number of the last lined included into this block of data.
-            data (ndarray): `n` lines of data as a numpy array of floats in [0,1].
+    Returns:
+        list: paths to the avi files, sorted in alphanumeric order (i.e. in
+            chronological order, given how ISIIS names them).
     """
     # get general logger
     log = logging.getLogger()
@@ -40,57 +44,782 @@ def stream(dir, n=1):
 
     # list available avi files
     all_avi = glob.glob(dir + '/*.avi')
-    # TODO check whether glob gets executed once or at every iteration of stream()
     # sort them in alphanumeric order (glob.glob() does not)
     all_avi.sort()
     n_avi = len(all_avi)
     if n_avi == 0:
-        raise RunTimeError('no avi files in ' + dir)
+        raise RuntimeError('no avi files in ' + dir)
     log.debug('found ' + str(n_avi) + ' avi files in "' + dir + '"')
+    
+    return(all_avi)
 
-    # TODO check that n is a divisor of 2048 = 1, 2, 4, 8, etc.
+def frames(dir, decoder='pyav', prefetch=0, cache=None, skip=0, index=None):
+    """
+    Get a stream of frames from a directory
+    
+    Args:
+        dir (str): path to input directory containing .avi files
+        decoder (str): library used to decode the avi files: 'pyav', 'opencv'
+            or 'ffmpeg' (see `decoders`).
+        prefetch (int): number of frames to decode in advance, in a background
+            thread; 0 decodes frames only when they are requested.
+        cache (str): path to a directory containing the frames of `dir`,
+            already decoded by `transcode()`; when given, frames are read from
+            there rather than decoded from the avi files.
+        skip (int): number of frames to skip at the beginning of the stream;
+            whole avi files are skipped without being read and the decoder
+            seeks to the first frame in the next one.
+        index (DataFrame): index of the avi files of `dir`, from `avi_index()`,
+            from which the number of frames of the skipped files is read; when
+            None, they are counted in the files.
+    
+    Yields:
+        dict: containing
+            filename (str): name of the current avi file.
+            start (datetime): timecode for the start of the current avi file (deduced from its name).
+            frame_nb (int): number of the frame in the current avi file, starting from 0.
+            data (ndarray): frame as a 2D numpy array of uint8.
+                NB: this array is reused from one iteration to the next; copy it
+                to keep it longer than that.
+    """
+    all_avi = list_avi(dir)
+    
+    if cache is not None:
+        source = _cached_frames(all_avi, cache, skip=skip)
+    else:
+        source = _frames(all_avi, decoder=decoder, skip=skip, index=index)
+    
+    if prefetch > 0:
+        yield from read_ahead(source, size=prefetch)
+    else:
+        yield from source
 
-    # initialise the block of data to be returned
-    block = np.empty((n, 2048))
-    i_b = 0
+def _frames(all_avi, decoder='pyav', skip=0, index=None):
+    # get general logger
+    log = logging.getLogger()
+    
+    decode = decoders[decoder]
+    
+    if index is not None:
+        n_frames_of = dict(zip(index['avi_file'], index['n_frames']))
 
     # iterate over files
     for avi in all_avi:
+        # skip whole files
+        if skip > 0:
+            if index is not None:
+                n_frames = n_frames_of[os.path.basename(avi)]
+            else:
+                n_frames = count_frames(avi)
+            if skip >= n_frames:
+                skip -= n_frames
+                continue
+        
         log.debug('open "' + avi + '"')
 
         timecode = datetime.datetime.strptime(os.path.basename(avi), '%Y%m%d%H%M%S.%f.avi')
         # TODO check for jumps in the video file time stamps
-
-        v = av.open(avi)
-        # TODO reconsider cv2 here because av actually has a lot of dependencies!
         
         # iterate over video frames of this file
-        i_f = 0
-        for frame in v.decode(video=0):
+        i_f = skip
+        for arr in decode(avi, skip=skip):
             log.debug('get frame ' + str(i_f))
             
-            # convert this frame into a 'greyscale' numpy array
-            arr = np.asarray(frame.to_image())[:,:,0]
-            # NB: frame.to_ndarray does not work with ISIIS frames which are 
-            #     in the lab8 color space.
-
-            # fill the block of data we want, line by line
-            for i_l in range(arr.shape[0]):
-                block[i_b,:] = arr[i_l,:]
-                i_b += 1
-                # when the block is full, return it and reinitialise it
-                if i_b == n:
-                    # TODO check if there is a better/faster way to do this; this performs the if test for every line
-                    yield({
-                        'filename': avi,
-                        'start': timecode,
-                        'frame_nb': i_f,
-                        'line_nb': i_l,
-                        'data': block/255.
-                    })
-                    # reinitialise block index
-                    i_b = 0
+            yield({
+                'filename': avi,
+                'start': timecode,
+                'frame_nb': i_f,
+                'data': arr
+            })
             
             # increase frame index
             i_f += 1
+        
+        skip = 0
+
+def count_frames(avi):
+    """
+    Count the frames in an avi file
+    
+    Args:
+        avi (str): path to the avi file.
+    
+    Returns:
+        int: number of frames, read from the header of the file or, when it is
+            not there, counted from the packets of the file (without decoding
+            them).
+    """
+    with av.open(avi) as v:
+        video = v.streams.video[0]
+        n_frames = video.frames
+        if n_frames == 0:
+            # NB: the last packet is an empty one, which flushes the decoder
+            n_frames = sum(1 for p in v.demux(video) if p.size > 0)
+    return(n_frames)
+
+def avi_index(dir, dest=None):
+    """
+    Index the avi files of a directory
+    
+    The index records the number of frames and the start timecode of every avi
+    file, from which the position of any frame in the stream, or the frame
+    recorded at any time, is known without reading the files. It is cached in
+    `dest`; only the avi files which are new, or whose size changed, since
+    the cache was written are read to update it.
+    
+    Args:
+        dir (str): path to input directory containing .avi files
+        dest (str): path to the file where to cache the index, as tsv; when
+            None, the index is not cached.
+    
+    Returns:
+        DataFrame: with one row per avi file, in order, and columns
+            avi_file (str): name of the file.
+            size (int): size of the file, in bytes.
+            n_frames (int): number of frames in the file.
+            start (datetime): timecode for the start of the file (deduced from
+                its name).
+            first_frame (int): number of the first frame of the file in the
+                whole stream, starting from 0.
+    """
+    # get general logger
+    log = logging.getLogger()
+    
+    all_avi = list_avi(dir)
+    
+    # read the frame counts already known
+    known = {}
+    if dest is not None and os.path.exists(dest):
+        cached = pd.read_csv(dest, sep='\t')
+        known = {(avi, size): n for avi, size, n in
+                 zip(cached['avi_file'], cached['size'], cached['n_frames'])}
+    
+    index = {'avi_file': [], 'size': [], 'n_frames': [], 'start': []}
+    n_new = 0
+    for avi in all_avi:
+        avi_file = os.path.basename(avi)
+        size = os.path.getsize(avi)
+        n_frames = known.get((avi_file, size))
+        if n_frames is None:
+            n_frames = count_frames(avi)
+            n_new += 1
+        index['avi_file'].append(avi_file)
+        index['size'].append(size)
+        index['n_frames'].append(n_frames)
+        index['start'].append(datetime.datetime.strptime(avi_file, '%Y%m%d%H%M%S.%f.avi'))
+    index = pd.DataFrame(index)
+    
+    if dest is not None and (n_new > 0 or len(known) != len(index)):
+        log.debug('write index of avi files in "' + dest + '"')
+        index.to_csv(dest + '.tmp', index=False, sep='\t', date_format='%Y-%m-%d %H:%M:%S.%f')
+        os.replace(dest + '.tmp', dest)
+    
+    index['first_frame'] = np.cumsum(index['n_frames']) - index['n_frames']
+    log.debug('indexed ' + str(index['n_frames'].sum()) + ' frames in ' + str(len(index)) + ' avi files')
+    
+    return(index)
+
+def locate(index, time, scan_per_s):
+    """
+    Find the line of the stream scanned at a given time
+    
+    Args:
+        index (DataFrame): index of the avi files, from `avi_index()`.
+        time (datetime): date and time.
+        scan_per_s (float): number of lines scanned per second.
+    
+    Returns:
+        int: number of the line scanned at `time` in the whole stream, starting
+            from 0; when no line was scanned at that time (before the first
+            avi file or between two of them), the number of the next line
+            scanned, which is the number of lines in the stream after the last
+            avi file.
+    """
+    # find the avi file recorded at that time, i.e. the last one started before
+    i = index['start'].searchsorted(time, side='right') - 1
+    if i < 0:
+        return(0)
+    avi = index.iloc[i]
+    # and the line in this file
+    line = int((time - avi['start']).total_seconds() * scan_per_s)
+    line = min(line, avi['n_frames'] * frame_height)
+    return(int(avi['first_frame']) * frame_height + line)
+
+def transcode(dir, dest, decoder='pyav'):
+    """
+    Decode all frames of a directory of avi files into a raw frame cache
+    
+    The grey levels of all frames are written, one after the other, as uint8
+    in `frames.raw` and their avi file, frame number and timecode are written
+    in `frames.tsv`, which is written last and therefore marks a complete cache.
+    This cache can then be read through `numpy.memmap`, without decoding, by
+    `frames(..., cache=dest)`. Nothing is done if the cache is already up to
+    date with the content of `dir`.
+    
+    Args:
+        dir (str): path to input directory containing .avi files
+        dest (str): path to the directory where to write the cache
+        decoder (str): library used to decode the avi files.
+    
+    Returns:
+        Nothing
+    """
+    # get general logger
+    log = logging.getLogger()
+    
+    all_avi = list_avi(dir)
+    
+    if read_cache_index(all_avi, dest) is not None:
+        log.info('frame cache in "' + dest + '" is up to date')
+        return
+    
+    log.info('write frame cache in "' + dest + '"')
+    os.makedirs(dest, exist_ok=True)
+    index = {'avi_file': [], 'frame_nb': [], 'timecode': []}
+    with open(os.path.join(dest, 'frames.raw'), 'wb') as raw:
+        for f in _frames(all_avi, decoder=decoder):
+            raw.write(np.ascontiguousarray(f['data']).data)
+            index['avi_file'].append(os.path.basename(f['filename']))
+            index['frame_nb'].append(f['frame_nb'])
+            index['timecode'].append(f['start'].strftime('%Y-%m-%d %H:%M:%S.%f'))
+    
+    index_file = os.path.join(dest, 'frames.tsv')
+    pd.DataFrame(index).to_csv(index_file + '.tmp', index=False, sep='\t')
+    os.replace(index_file + '.tmp', index_file)
+    log.info(str(len(index['avi_file'])) + ' frames written in the cache')
+
+def read_cache_index(all_avi, cache):
+    """
+    Read the index of a frame cache written by `transcode()`
+    
+    Args:
+        all_avi (list): paths to the avi files which should be in the cache.
+        cache (str): path to the cache directory.
+    
+    Returns:
+        DataFrame: the index (avi_file, frame_nb, timecode), or None if the
+            cache is incomplete or does not match `all_avi`.
+    """
+    index_file = os.path.join(cache, 'frames.tsv')
+    if not os.path.exists(index_file):
+        return(None)
+    index = pd.read_csv(index_file, sep='\t')
+    
+    # check that the cache contains the same avi files, and all their frames
+    cached_avi = list(pd.unique(index['avi_file']))
+    if cached_avi != [os.path.basename(avi) for avi in all_avi]:
+        return(None)
+    n_bytes = len(index) * frame_height * frame_width
+    if os.path.getsize(os.path.join(cache, 'frames.raw')) != n_bytes:
+        return(None)
+    
+    return(index)
+
+def _cached_frames(all_avi, cache, skip=0):
+    # get general logger
+    log = logging.getLogger()
+    
+    index = read_cache_index(all_avi, cache)
+    if index is None:
+        raise RuntimeError('frame cache in "' + cache + '" is missing or out of date')
+    log.debug('read frames from cache in "' + cache + '"')
+    
+    # map the cache in memory
+    mm = np.memmap(os.path.join(cache, 'frames.raw'), dtype=np.uint8, mode='r',
+                   shape=(len(index), frame_height, frame_width))
+    
+    # get the full path to the avi files
+    paths = {os.path.basename(avi): avi for avi in all_avi}
+    
+    for i, (avi, frame_nb, timecode) in enumerate(index.itertuples(index=False)):
+        if i < skip:
+            continue
+        yield({
+            'filename': paths[avi],
+            'start': datetime.datetime.strptime(timecode, '%Y-%m-%d %H:%M:%S.%f'),
+            'frame_nb': frame_nb,
+            'data': mm[i]
+        })
+
+def decode_pyav(avi, skip=0):
+    """
+    Decode the frames of an avi file with PyAV
+    
+    Args:
+        avi (str): path to the avi file.
+        skip (int): number of frames to skip at the beginning of the file.
+    
+    Yields:
+        ndarray: 2D array of uint8 with the grey levels of each frame; it is
+            reused from one iteration to the next.
+    """
+    # preallocate the frame in which to extract the content of decoded frames
+    buf = np.empty((frame_height, frame_width), dtype=np.uint8)
+    
+    # try to seek in the file first, and decode it from the start otherwise
+    for seek in (True, False):
+        with av.open(avi) as v:
+            video = v.streams.video[0]
+            # seek to the key frame before the first frame to decode
+            # NB: frames are then identified by their time stamp, or by their
+            #     decoding time stamp when they have none
+            seek = seek and skip > 0 and video.average_rate is not None
+            if seek:
+                t0 = video.start_time or 0
+                v.seek(t0 + int(skip / video.average_rate / video.time_base), stream=video, backward=True)
+            i_f = 0
+            located = not seek
+            for frame in v.decode(video):
+                if seek:
+                    ts = frame.pts if frame.pts is not None else frame.dts
+                    if ts is not None:
+                        i_f = round((ts - t0) * video.time_base * video.average_rate)
+                        located = True
+                    elif not located:
+                        # the frames after the key frame cannot be identified
+                        break
+                # decode, but do not extract, the frames before the first one
+                if i_f >= skip:
+                    # extract the 'greyscale' content of this frame
+                    yield(luminance(frame, out=buf))
+                i_f += 1
+        if located:
+            return
+        log = logging.getLogger()
+        log.debug('frames of "' + avi + '" have no time stamps, decoding it from the start')
+
+def decode_opencv(avi, skip=0):
+    """
+    Decode the frames of an avi file with OpenCV
+    
+    Args:
+        avi (str): path to the avi file.
+        skip (int): number of frames to skip at the beginning of the file.
+    
+    Yields:
+        ndarray: 2D array of uint8 with the grey levels of each frame; it is
+            reused from one iteration to the next.
+    """
+    # preallocate the decoded (BGR) frame and the extracted grey levels
+    bgr = np.empty((frame_height, frame_width, 3), dtype=np.uint8)
+    buf = np.empty((frame_height, frame_width), dtype=np.uint8)
+    
+    cap = cv2.VideoCapture(avi)
+    if not cap.isOpened():
+        raise RuntimeError('cannot open "' + avi + '" with OpenCV')
+    if skip > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, skip)
+    try:
+        while True:
+            ok, bgr = cap.read(image=bgr)
+            if not ok:
+                break
+            # keep the red channel, as PyAV's conversion to RGB does
+            yield(cv2.extractChannel(bgr, 2, dst=buf))
+    finally:
+        cap.release()
+
+def decode_ffmpeg(avi, skip=0):
+    """
+    Decode the frames of an avi file with an ffmpeg subprocess
+    
+    ffmpeg converts the frames to grey levels and writes them, raw, in a pipe.
+    
+    Args:
+        avi (str): path to the avi file.
+        skip (int): number of frames to skip at the beginning of the file.
+    
+    Yields:
+        ndarray: 2D array of uint8 with the grey levels of each frame; it is
+            reused from one iteration to the next.
+    """
+    buf = np.empty((frame_height, frame_width), dtype=np.uint8)
+    mem = memoryview(buf).cast('B')
+    
+    cmd = ['ffmpeg', '-loglevel', 'error', '-nostdin']
+    if skip > 0:
+        # seek to the time of the first frame
+        # NB: half a frame before, to be robust to rounding
+        with av.open(avi) as v:
+            rate = v.streams.video[0].average_rate
+        cmd += ['-ss', str(float((skip - 0.5) / rate))]
+    cmd += ['-i', avi, '-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+        try:
+            while True:
+                # read exactly one frame from the pipe
+                n_read = 0
+                while n_read < buf.nbytes:
+                    n = p.stdout.readinto(mem[n_read:])
+                    if not n:
+                        break
+                    n_read += n
+                if n_read < buf.nbytes:
+                    break
+                yield(buf)
+        except GeneratorExit:
+            # stop decoding when the consumer stops reading frames
+            p.kill()
+            raise
+        if p.wait() != 0:
+            raise RuntimeError('ffmpeg failed to decode "' + avi + '": ' + p.stderr.read().decode())
+
+# available decoders
+decoders = {
+    'pyav': decode_pyav,
+    'opencv': decode_opencv,
+    'ffmpeg': decode_ffmpeg
+}
+
+def benchmark_decoders(dir, n=100):
+    """
+    Measure the speed of the available decoders
+    
+    Args:
+        dir (str): path to input directory containing .avi files
+        n (int): number of frames to decode with each decoder
+    
+    Returns:
+        dict: number of frames decoded per second, for each decoder; None when
+            the decoder failed.
+    """
+    # get general logger
+    log = logging.getLogger()
+    
+    all_avi = list_avi(dir)
+    
+    def decode(decoder):
+        i = 0
+        for f in _frames(all_avi, decoder=decoder):
+            i += 1
+            if i == n:
+                break
+        return(i)
+    
+    fps = {}
+    for decoder in decoders:
+        log.info('benchmark decoder `' + decoder + '`')
+        try:
+            # NB: decode the frames once before timing, so that all decoders
+            #     read them from the disk cache and are started already
+            decode(decoder)
+            start = time.time()
+            i = decode(decoder)
+        except Exception as e:
+            log.warning('decoder `' + decoder + '` failed: ' + str(e))
+            fps[decoder] = None
+            continue
+        elapsed = time.time() - start
+        fps[decoder] = i / elapsed
+        log.info(f'{decoder}: {i} frames in {elapsed:.3f}s ({fps[decoder]:.2f} frames/s)')
+    
+    return(fps)
+
+def read_ahead(source, size):
+    """
+    Read frames ahead of their consumption, in a background thread
+    
+    Frames are copied into a ring of reusable buffers and stored in a queue of
+    at most `size` frames, so that decoding runs while previous frames are
+    being processed. The time spent waiting for frames (i.e. when the queue is
+    starved because decoding is slower than processing) is reported in the log
+    for each avi file.
+    
+    Args:
+        source (iterable): frames, as yielded by `frames()`.
+        size (int): maximum number of frames to read ahead.
+    
+    Yields:
+        dict: the elements of `source`, in the same order.
+    """
+    # get general logger
+    log = logging.getLogger()
+    
+    # prepare buffers for the frames in the queue, the one being decoded and
+    # the one being consumed
+    free = queue.Queue()
+    for i in range(size + 2):
+        free.put(np.empty((frame_height, frame_width), dtype=np.uint8))
+    full = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    
+    def put(item):
+        # wait for room in the queue, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                full.put(item, timeout=0.1)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+    
+    def decode():
+        try:
+            for f in source:
+                buf = free.get()
+                np.copyto(buf, f['data'])
+                f['data'] = buf
+                if not put(f):
+                    break
+            else:
+                put(None)
+        except Exception as e:
+            # pass errors on to the consumer
+            put(e)
+        finally:
+            source.close()
+    
+    decoder = threading.Thread(target=decode, name='apeep-decoder', daemon=True)
+    decoder.start()
+    
+    # monitor queue starvation
+    n_starved = 0
+    t_starved = 0.
+    avi = None
+    buf = None
+    try:
+        while True:
+            waited = None
+            try:
+                f = full.get_nowait()
+            except queue.Empty:
+                start = time.time()
+                f = full.get()
+                waited = time.time() - start
+            
+            if isinstance(f, Exception):
+                raise f
+            
+            # report starvation at the end of each avi file
+            if avi is not None and (f is None or f['filename'] != avi):
+                if n_starved > 0:
+                    log.info(f'prefetch queue starved {n_starved} times ({t_starved:.3f}s) while reading "{avi}"')
+                n_starved = 0
+                t_starved = 0.
+            # NB: the first frame is always waited for; do not count it
+            if waited is not None and avi is not None:
+                n_starved += 1
+                t_starved += waited
+            
+            # recycle the buffer of the previous frame
+            if buf is not None:
+                free.put(buf)
+            
+            if f is None:
+                break
+            
+            avi = f['filename']
+            buf = f['data']
+            yield(f)
+    finally:
+        stop.set()
+        decoder.join()
 
+def luminance(frame, out=None):
+    """
+    Extract the grey levels of a decoded video frame
+    
+    Reads the luminance plane of the frame directly when possible, which avoids
+    converting the whole frame to RGB (frame.to_ndarray does not work with
+    ISIIS frames which are in the lab8 color space, and frame.to_image is slow).
+    
+    Args:
+        frame (av.VideoFrame): frame decoded by PyAV.
+        out (ndarray): preallocated 2D array of uint8, of the size of the frame,
+            in which to copy the grey levels when they cannot be read in place.
+    
+    Returns:
+        ndarray: 2D array of uint8; either a view on the memory of `frame`
+            or `out`.
+    """
+    fmt = frame.format.name
+    
+    if fmt in luma_formats:
+        # read the luminance plane in place
+        plane = frame.planes[0]
+        arr = np.frombuffer(plane, dtype=np.uint8)
+        arr = arr.reshape((plane.height, plane.line_size))
+        # when lines are padded in memory, copy the useful part in the output
+        if plane.line_size != plane.width:
+            arr = arr[:,0:plane.width]
+            if out is not None:
+                np.copyto(out, arr)
+                arr = out
+    
+    elif fmt == 'pal8':
+        # get the index of each pixel in the colour palette
+        plane = frame.planes[0]
+        idx = np.frombuffer(plane, dtype=np.uint8)
+        idx = idx.reshape((plane.height, plane.line_size))[:,0:plane.width]
+        # get the red channel of the palette (stored as BGRA)
+        red = np.frombuffer(frame.planes[1], dtype=np.uint8)[2::4]
+        # and look pixels up in it, unless it is the identity
+        if np.array_equal(red, np.arange(256)):
+            arr = idx
+        else:
+            # NB: np.take() would convert the whole frame to indices first
+            arr = cv2.LUT(idx, np.ascontiguousarray(red), dst=out)
+    
+    else:
+        # fall back on the (slow) conversion to RGB
+        arr = np.asarray(frame.to_image())[:,:,0]
+    
+    return(arr)
+
+def stream(dir, n=1, decoder='pyav', prefetch=0, cache=None, dtype='float64', start=0, index=None):
+    """
+    Get a stream of lines of pixels from a directory
+    
+    ISIIS scans lines, hence creating a continuous stream of lines of pixels. 
+    This stream is cut into 2048x2048 frames (lines are scanned from top to
+    bottom in each frame), which are stored in successive avi files.
+    This generator abstracts that storage, loops over avi files and their
+    frames to return blocks of `n` scanned lines at a time
+    
+    Args:
+        dir (str): path to input directory containing .avi files
+        n (int): number of lines of the stream to return at each iteration
+        decoder (str): library used to decode the avi files: 'pyav', 'opencv'
+            or 'ffmpeg' (see `decoders`).
+        prefetch (int): number of frames to decode in advance, in a background
+            thread; 0 decodes frames only when they are requested.
+        cache (str): path to a directory of frames decoded by `transcode()`,
+            to read instead of the avi files.
+        dtype (str): type of the returned data: 'float64', 'float32' or
+            'uint8'.
+        start (int): number of the first line to return, in the whole stream
+            starting from 0 (see `locate()` to get it from a time); the frames
+            before it are skipped, without decoding them.
+        index (DataFrame): index of the avi files of `dir`, from `avi_index()`,
+            to skip whole files without opening them.
+    
+    Yields:
+         dict: containing
+            filename (str): name of the current avi file.
+            start (datetime): timecode for the start of the current avi file (deduced from its name).
+            frame_nb (int): number of the frame in the current avi file, starting from 0.
+            line_nb (int): number of the last lined included into this block of data.
+            first_filename, first_frame_nb, first_line_nb: avi file, frame 
+                number and line number of the first line of this block.
+            data (ndarray): `n` lines of data as a numpy array of floats in [0,1]
+                (or of uint8 in [0,255], when `dtype` is 'uint8').
+                NB: this array is reused from one iteration to the next; copy it
+                to keep it longer than that.
+    """
+    source = frames(dir, decoder=decoder, prefetch=prefetch, cache=cache,
+                    skip=start // frame_height, index=index)
+    yield from blocks(source, n=n, dtype=dtype, offset=start % frame_height)
+
+def blocks(source, n=1, dtype='float64', offset=0):
+    """
+    Cut a stream of frames into blocks of lines of pixels
+    
+    Args:
+        source (iterable): frames, as yielded by `frames()`.
+        n (int): number of lines of the stream to return at each iteration
+        dtype (str): type of the returned data: 'float64' or 'float32' for
+            grey levels in [0,1], 'uint8' for the raw grey levels in [0,255].
+        offset (int): number of lines to skip at the beginning of the stream.
+    
+    Yields:
+         dict: see `stream()`.
+    """
+    n = int(n)
+    dtype = np.dtype(dtype)
+    
+    # initialise the block of data to be returned when it spans several frames
+    block = np.empty((n, frame_width), dtype=dtype)
+    i_b = 0
+    # and the frame converted to `dtype`, from which blocks contained within a
+    # single frame are returned as views
+    # NB: raw frames are used directly when `dtype` is uint8
+    if dtype != np.uint8:
+        frame_data = np.empty((frame_height, frame_width), dtype=dtype)
+    
+    for f in source:
+        arr = f['data']
+        n_lines = arr.shape[0]
+        
+        # skip the first lines, without converting them
+        if offset >= n_lines:
+            offset -= n_lines
+            continue
+        
+        # convert the whole frame at once, when blocks can fit in it
+        if n <= n_lines:
+            if dtype == np.uint8:
+                frame_data = arr
+            else:
+                np.divide(arr, 255., out=frame_data, dtype=dtype)
+        
+        # cut the frame into blocks
+        i_l = offset
+        offset = 0
+        while i_l < n_lines:
+            # store the position of the first line of the block
+            if i_b == 0:
+                first = (f['filename'], f['frame_nb'], i_l)
+            
+            if i_b == 0 and n_lines - i_l >= n:
+                # the whole block is within this frame: return a view
+                data = frame_data[i_l:i_l+n,:]
+                i_l += n
+            else:
+                # fill the block with as many lines as possible from this frame
+                k = min(n - i_b, n_lines - i_l)
+                if n <= n_lines:
+                    block[i_b:i_b+k,:] = frame_data[i_l:i_l+k,:]
+                elif dtype == np.uint8:
+                    block[i_b:i_b+k,:] = arr[i_l:i_l+k,:]
+                else:
+                    np.divide(arr[i_l:i_l+k,:], 255., out=block[i_b:i_b+k,:], dtype=dtype)
+                i_b += k
+                i_l += k
+                # when the block is not full, carry it over to the next frame
+                if i_b < n:
+                    break
+                data = block
+                # reinitialise block index
+                i_b = 0
+            
+            yield({
+                'filename': f['filename'],
+                'start': f['start'],
+                'frame_nb': f['frame_nb'],
+                'line_nb': i_l - 1,
+                'first_filename': first[0],
+                'first_frame_nb': first[1],
+                'first_line_nb': first[2],
+                'data': data
+            })
+
+def peek(source, n_lines):
+    """
+    Read the first lines of a stream of frames without consuming them
+    
+    Frames are kept in memory and replayed, so that the beginning of the
+    stream can be inspected (e.g. to initialise the flat-fielding) and then
+    processed without decoding it twice.
+    
+    Args:
+        source (iterable): frames, as yielded by `frames()`.
+        n_lines (int): minimum number of lines to read.
+    
+    Returns:
+        list: the first frames of `source`, containing at least `n_lines` lines.
+        iterator: frames of `source`, starting from the first one.
+    """
+    source = iter(source)
+    head = []
+    n = 0
+    while n < n_lines:
+        try:
+            f = next(source)
+        except StopIteration:
+            raise RuntimeError('the input contains less than ' + str(n_lines) + ' lines')
+        # copy the frame since its data may be reused by the source
+        f = dict(f, data=f['data'].copy())
+        head.append(f)
+        n += f['data'].shape[0]
+    
+    return(head, itertools.chain(head, source))
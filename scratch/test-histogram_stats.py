@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# Check that reading the limits of `enhance()` and the segmentation threshold
+# from histograms (`enhance > percentiles: histogram`) gives the same
+# particles as sorting the pixels of the shrunk image (`percentiles: exact`),
+# with each thresholding method, on noisy images, where the way pixels are
+# sampled matters most.
+
+import itertools
+import os
+
+import numpy as np
+import skimage.transform
+import yaml
+
+import apeep
+import apeep.timers as t
+
+# default options
+with open(os.path.join(os.path.dirname(apeep.__file__), 'config.yaml')) as f:
+    cfg = yaml.safe_load(f)
+
+# maximum differences tolerated between the two
+tol_limit = 0.001      # limits of the rescale of grey levels, in [0,1]
+tol_threshold = 0.001  # segmentation threshold, in [0,1]
+tol_particles = 0.02   # relative difference in the number of particles
+
+def noisy_image(seed, shape=(10000, 2048), noise=0.1, n_particles=200):
+    # flat-fielded image: light background with gaussian noise and dark,
+    # elliptic, particles
+    rng = np.random.default_rng(seed)
+    img = rng.normal(0.85, noise, shape)
+    rows, cols = np.ogrid[0:shape[0], 0:shape[1]]
+    for i in range(n_particles):
+        r, c = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        a, b = rng.uniform(5, 40, 2)
+        box = (slice(max(r - 40, 0), r + 40), slice(max(c - 40, 0), c + 40))
+        inside = ((rows[box[0]] - r) / a)**2 + ((cols[:,box[1]] - c) / b)**2 < 1
+        img[box][inside] -= rng.uniform(0.2, 0.6)
+    return(np.clip(img, 0, 1))
+
+# value of `segment > threshold` for each method
+method_thresholds = {'percentile': 1.2, 'otsu': 0, 'q1': -2.9}
+
+def process(img, percentiles, method):
+    # enhance and segment an image as `process_image()` does
+    cfg['enhance']['percentiles'] = percentiles
+    thresholds = (cfg['enhance']['dark_threshold'], cfg['enhance']['light_threshold'])
+    if percentiles == 'histogram':
+        stats = apeep.image_stats(img)
+        limits = apeep.enhance_limits(stats, cfg)
+    else:
+        stats = None
+        img_small = skimage.transform.rescale(apeep.to_float(img), 0.2, anti_aliasing=False)
+        limits = np.percentile(img_small, thresholds)
+    # NB: the statistics are updated to describe the enhanced image
+    img_eq = apeep.enhance(img, cfg, stats=stats)
+    gray_threshold = apeep.segmentation_threshold(img_eq,
+        method=method, threshold=method_thresholds[method], stats=stats)
+    labels = apeep.segment(img_eq, gray_threshold,
+        dilate=cfg['segment']['dilate'], erode=cfg['segment']['erode'],
+        min_area=cfg['segment']['reg_min_area'],
+        max_area=cfg['segment']['reg_max_area'])
+    return(np.array(limits), gray_threshold, labels.max())
+
+for method, dtype, seed in itertools.product(method_thresholds, [np.float64, np.float32, np.uint8], range(2)):
+    img = noisy_image(seed)
+    img = (img * 255).round().astype(np.uint8) if dtype == np.uint8 else img.astype(dtype)
+
+    s = t.b()
+    limits_exact, thr_exact, n_exact = process(img, 'exact', method)
+    time_exact = t.e(s)
+    s = t.b()
+    limits_hist, thr_hist, n_hist = process(img, 'histogram', method)
+    time_hist = t.e(s)
+
+    print(f'{method} {np.dtype(dtype).name} {seed}: '
+          f'limits {limits_exact.round(5)} vs {limits_hist.round(5)}, '
+          f'threshold {thr_exact:.5f} vs {thr_hist:.5f}, '
+          f'{n_exact} vs {n_hist} particles, '
+          f'{time_exact:.2f}s vs {time_hist:.2f}s')
+    assert np.all(np.abs(limits_exact - limits_hist) < tol_limit)
+    assert abs(thr_exact - thr_hist) < tol_threshold
+    assert abs(n_exact - n_hist) <= tol_particles * n_exact
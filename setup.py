@@ -28,7 +28,7 @@ setuptools.setup(
     package_data={
         'apeep': ['config.yaml'],
     },
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=[
         'numpy>=1.17',          # array operations
         'scikit-image>=0.16',   # image manipulation